@@ -1,69 +1,117 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
 
-class AdaBelief(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7,name = "AdaBelief"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._beta_1 = beta_1
-        self._beta_2 = beta_2
-        self._epsilon = epsilon
+from CustomOptimizer import CustomOptimizer
+from functional import adam_rule
+
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class AdaBelief(CustomOptimizer):
+    _slot_names = ("_m", "_s")
+    _supports_sharding = True
+
+    def __init__(self, learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7,name = "AdaBelief", moment_dtype = None, block_size = 64, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        self._beta_1 = self._build_hyperparameter(beta_1, "beta_1")
+        self._beta_2 = self._build_hyperparameter(beta_2, "beta_2")
+        self._epsilon = self._build_hyperparameter(epsilon, "epsilon")
+        # moment_dtype でモーメントを保持するデータ型を指定する (CustomOptimizer._set_moment_dtype)
+        self._set_moment_dtype(moment_dtype, block_size)
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "beta_1": self._serialize_hyperparameter(self._beta_1),
+            "beta_2": self._serialize_hyperparameter(self._beta_2),
+            "epsilon": self._serialize_hyperparameter(self._epsilon),
+            "moment_dtype": self._moment_dtype,
+            "block_size": self._block_size,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
         # 一次モーメントを保持する変数
         self._m = list()
         # 二次モーメントを保持する変数
         self._s = list()
         for variable in var_list:
-            self._m.append(
-                self.add_variable_from_reference(
-                    model_variable = variable, variable_name = "m",
-                    # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
-                )
-            )
-            self._s.append(
-                self.add_variable_from_reference(
-                    model_variable = variable, variable_name = "s",
-                    # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
-                )
-            )
+            self._m.append(self._add_moment(variable, "m"))
+            self._s.append(self._add_moment(variable, "s", second = True))
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        beta_1 = tf.cast(self._beta_1, variable.dtype)
-        beta_2 = tf.cast(self._beta_2, variable.dtype)
-        epsilon = tf.cast(self._epsilon, variable.dtype)
-        # イテレーション数を取得
-        iteration = tf.cast(self.iterations + 1, variable.dtype)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        beta_1 = self._get_hyper("beta_1", variable.dtype)
+        beta_2 = self._get_hyper("beta_2", variable.dtype)
+        # バイアス補正を畳み込んだ学習率と epsilon (ステップごとに1度だけ計算したものを取り出す)
+        step_size, epsilon_hat = self._get_corrected_step(variable.dtype)
+
+        # 一次モーメントと二次モーメントを取得
+        m, s = self._get_slots(variable)
+
+        if self._moment_dtype is not None:
+            # 低精度で保持しているモーメントは, 取り出してから functional と同じ更新式で更新する
+            update, (m_value, s_value) = adam_rule(
+                tf.convert_to_tensor(gradient), self._read_moment(m, variable), self._read_moment(s, variable, second = True),
+                beta_1, beta_2, step_size, epsilon_hat, belief = True
+            )
+            self._write_moment(m, m_value)
+            self._write_moment(s, s_value, second = True)
+            variable.assign_add( update )
+            return
+
+        # 更新量とモーメントは functional と同じ更新式で求める
+        update, (m_value, s_value) = adam_rule(gradient, m, s, beta_1, beta_2, step_size, epsilon_hat, belief = True)
+        m.assign(m_value)
+        s.assign(s_value)
+        # パラメータは assign_add 関数でその場で更新する
+        variable.assign_add( update )
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を更新する
+    def _sharded_rule(self, gradient, param, slots):
+        m, s = slots
+        step_size, epsilon_hat = self._get_corrected_step(param.dtype)
+        return adam_rule(
+            gradient, m, s, self._get_hyper("beta_1", param.dtype), self._get_hyper("beta_2", param.dtype),
+            step_size, epsilon_hat, belief = True
+        )
 
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+    def _fused_update_step(self, gradients, variables):
+        dtype = variables[0].dtype
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        beta_1 = self._get_hyper("beta_1", dtype)
+        beta_2 = self._get_hyper("beta_2", dtype)
+        # バイアス補正を畳み込んだ学習率と epsilon (ステップごとに1度だけ計算したものを取り出す)
+        step_size, epsilon_hat = self._get_corrected_step(dtype)
 
-        # 一次モーメントを取得
-        m = self._m[self._index_dict[var_key]]
-        # 二次モーメントを取得
-        s = self._s[self._index_dict[var_key]]
-        
-        # 一次モーメントを更新
-        m.assign(beta_1 * m + (1 - beta_1) * gradient)
-        # 二次モーメントを更新
-        s.assign(beta_2 * s + (1 - beta_2) * (gradient - m) * (gradient - m))
+        m_list, s_list = zip(*[self._get_slots(variable) for variable in variables])
 
-        # 補正項の計算
-        m_hat = m / (1 - tf.math.pow(beta_1, iteration))
-        s_hat = s / (1 - tf.math.pow(beta_2, iteration))
+        # 勾配とモーメントをそれぞれ1つのテンソルに連結
+        gradient = self._flatten_concat(gradients)
+        m = self._flatten_concat(m_list)
+        s = self._flatten_concat(s_list)
 
-        # パラメータは assign 関数で更新する
-        variable.assign( variable - learning_rate * m_hat / (tf.math.sqrt(s_hat) + epsilon) )
+        # 連結したテンソルにも, 変数ごとの更新と同じ更新式を用いる
+        update, (m, s) = adam_rule(gradient, m, s, beta_1, beta_2, step_size, epsilon_hat, belief = True)
+
+        # 分割して各変数に書き戻す
+        for x, value in zip(m_list, self._split_like(m, m_list)):
+            x.assign(value)
+        for x, value in zip(s_list, self._split_like(s, s_list)):
+            x.assign(value)
+        for variable, value in zip(variables, self._split_like(update, variables)):
+            variable.assign_add(value)
+
+    # Instrumentation で記録するモーメントの統計量
+    def _moment_statistics(self, var_list):
+        beta_2 = self._get_hyper("beta_2", tf.float32)
+        iteration = tf.cast(self.iterations, tf.float32)
+        s_hat = list()
+        for variable in var_list:
+            _, s = self._get_slots(variable)
+            if self._moment_dtype is not None:
+                s = self._read_moment(s, variable, second = True)
+            s_hat.append(tf.cast(s, tf.float32) / (1 - tf.math.pow(beta_2, iteration)))
+        return {
+            "s_hat_min": tf.reduce_min([tf.reduce_min(x) for x in s_hat]),
+            "s_hat_max": tf.reduce_max([tf.reduce_max(x) for x in s_hat]),
+        }
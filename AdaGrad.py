@@ -1,45 +1,97 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
-
-class AdaGrad(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.001, epsilon = 1e-7,name = "AdaGrad"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._epsilon = epsilon
+
+from CustomOptimizer import CustomOptimizer
+from functional import adagrad_rule
+
+# fused = True には対応しない
+# (連結と分割の往復で全ての累積を書き直すので, ResourceApplyAdagradV2 で変数ごとにその場で更新するより遅い. benchmark.py --suite fused)
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class AdaGrad(CustomOptimizer):
+    _slot_names = ("_h",)
+    _supports_sharding = True
+
+    def __init__(self, learning_rate = 0.001, epsilon = 1e-7,name = "AdaGrad", factored = False, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        self._epsilon = self._build_hyperparameter(epsilon, "epsilon")
+        # factored = True の場合, 2次元以上の変数の勾配の二乗の累積を, 最後の2軸の行ごとと列ごとの累積のみで保持する
+        # 1次元以下の変数は, これまで通りパラメータと同じ形で保持する
+        self._factored = factored
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "epsilon": self._serialize_hyperparameter(self._epsilon),
+            "factored": self._factored,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
         # 勾配の二乗を累積する変数
         self._h = list()
         for variable in var_list:
+            if self._is_factored(variable):
+                self._h.append(self._add_factored_slot(variable, "h"))
+                continue
             self._h.append(
                 self.add_variable_from_reference(
                     model_variable = variable, variable_name = "h",
                     # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
+                    initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
                 )
             )
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        epsilon = tf.cast(self._epsilon, variable.dtype)
-
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", variable.dtype)
+        epsilon = self._get_hyper("epsilon", variable.dtype)
 
         # 勾配の二乗の累積を取得
-        h = self._h[self._index_dict[var_key]]
+        h, = self._get_slots(variable)
+
+        if self._is_factored(variable):
+            # 疎な勾配は密にしてから, 行ごとと列ごとに勾配の二乗を累積する
+            gradient = tf.convert_to_tensor(gradient)
+            row, col = h
+            row_square, col_square = self._factored_square(gradient)
+            row.assign_add(row_square)
+            col.assign_add(col_square)
+            # 累積から勾配の二乗の累積を復元して更新する
+            h = self._reconstruct_factored(row, col)
+            variable.assign_sub( learning_rate * gradient / (tf.math.sqrt(h) + epsilon) )
+            return
+
+        if isinstance(gradient, tf.IndexedSlices):
+            # 勾配のある行のみ勾配の二乗を累積する
+            h.scatter_add(tf.IndexedSlices(gradient.values * gradient.values, gradient.indices))
+            # 勾配のある行のパラメータのみ更新する
+            h_rows = tf.gather(h, gradient.indices)
+            variable.scatter_sub(
+                tf.IndexedSlices(learning_rate * gradient.values / (tf.math.sqrt(h_rows) + epsilon), gradient.indices)
+            )
+            return
         
-        # 勾配の二乗の累積を更新
-        h.assign(h + gradient * gradient)
-        # パラメータは assign 関数で更新する
-        variable.assign( variable - learning_rate * gradient / (tf.math.sqrt(h) + epsilon) )
+        # 密な勾配は, 勾配の二乗の累積とパラメータを1つのカーネルでその場で更新する
+        tf.raw_ops.ResourceApplyAdagradV2(
+            var = variable.handle, accum = h.handle,
+            lr = learning_rate, epsilon = epsilon, grad = gradient,
+        )
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を更新する
+    def _sharded_rule(self, gradient, param, slots):
+        h, = slots
+        return adagrad_rule(
+            gradient, h, self._get_hyper("learning_rate", param.dtype), self._get_hyper("epsilon", param.dtype)
+        )
+
+    # Instrumentation で記録する勾配の二乗の累積の統計量
+    def _moment_statistics(self, var_list):
+        h = list()
+        for variable in var_list:
+            x, = self._get_slots(variable)
+            h.append(self._reconstruct_factored(*x) if isinstance(x, tuple) else x)
+        return {
+            "h_min": tf.reduce_min([tf.reduce_min(x) for x in h]),
+            "h_max": tf.reduce_max([tf.reduce_max(x) for x in h]),
+        }
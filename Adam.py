@@ -1,69 +1,138 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
 
-class Adam(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7,name = "Adam"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._beta_1 = beta_1
-        self._beta_2 = beta_2
-        self._epsilon = epsilon
+from CustomOptimizer import CustomOptimizer
+from functional import adam_direction, adam_moments, adam_rule
+
+# fused = True には対応しない
+# (連結と分割の往復で全てのモーメントを書き直すので, ResourceApplyAdam で変数ごとにその場で更新するより遅い. benchmark.py --suite fused)
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class Adam(CustomOptimizer):
+    _slot_names = ("_m", "_v")
+    _supports_sharding = True
+
+    def __init__(self, learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7,name = "Adam", lazy = False, moment_dtype = None, block_size = 64, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        self._beta_1 = self._build_hyperparameter(beta_1, "beta_1")
+        self._beta_2 = self._build_hyperparameter(beta_2, "beta_2")
+        self._epsilon = self._build_hyperparameter(epsilon, "epsilon")
+        # moment_dtype でモーメントを保持するデータ型を指定する (CustomOptimizer._set_moment_dtype)
+        self._set_moment_dtype(moment_dtype, block_size)
+        # lazy = True の場合, 疎な勾配に対して勾配のある行のモーメントのみ更新する
+        self._lazy = lazy
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "beta_1": self._serialize_hyperparameter(self._beta_1),
+            "beta_2": self._serialize_hyperparameter(self._beta_2),
+            "epsilon": self._serialize_hyperparameter(self._epsilon),
+            "lazy": self._lazy,
+            "moment_dtype": self._moment_dtype,
+            "block_size": self._block_size,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
         # 一次モーメントを保持する変数
         self._m = list()
         # 二次モーメントを保持する変数
         self._v = list()
         for variable in var_list:
-            self._m.append(
-                self.add_variable_from_reference(
-                    model_variable = variable, variable_name = "m",
-                    # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
-                )
-            )
-            self._v.append(
-                self.add_variable_from_reference(
-                    model_variable = variable, variable_name = "v",
-                    # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
-                )
-            )
+            self._m.append(self._add_moment(variable, "m"))
+            self._v.append(self._add_moment(variable, "v", second = True))
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        beta_1 = tf.cast(self._beta_1, variable.dtype)
-        beta_2 = tf.cast(self._beta_2, variable.dtype)
-        epsilon = tf.cast(self._epsilon, variable.dtype)
-        # イテレーション数を取得
-        iteration = tf.cast(self.iterations + 1, variable.dtype)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        beta_1 = self._get_hyper("beta_1", variable.dtype)
+        beta_2 = self._get_hyper("beta_2", variable.dtype)
+        # バイアス補正を畳み込んだ学習率と epsilon (ステップごとに1度だけ計算したものを取り出す)
+        step_size, epsilon_hat = self._get_corrected_step(variable.dtype)
 
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        # 一次モーメントと二次モーメントを取得
+        m, v = self._get_slots(variable)
 
-        # 一次モーメントを取得
-        m = self._m[self._index_dict[var_key]]
-        # 二次モーメントを取得
-        v = self._v[self._index_dict[var_key]]
-        
-        # 一次モーメントを更新
-        m.assign(beta_1 * m + (1 - beta_1) * gradient)
-        # 二次モーメントを更新
-        v.assign(beta_2 * v + (1 - beta_2) * gradient * gradient)
+        if self._moment_dtype is not None or (isinstance(gradient, tf.IndexedSlices) and not self._lazy):
+            m, v = self._update_moments(gradient, variable)
+            # パラメータは assign_sub 関数でその場で更新する
+            variable.assign_sub( step_size * adam_direction(m, v, epsilon_hat) )
+            return
+
+        if isinstance(gradient, tf.IndexedSlices):
+            # 勾配のある行のモーメントのみを取り出して, functional と同じ更新式で更新
+            update_rows, (m_rows, v_rows) = adam_rule(
+                gradient.values, tf.gather(m, gradient.indices), tf.gather(v, gradient.indices),
+                beta_1, beta_2, step_size, epsilon_hat
+            )
+            m.scatter_update(tf.IndexedSlices(m_rows, gradient.indices))
+            v.scatter_update(tf.IndexedSlices(v_rows, gradient.indices))
 
-        # 補正項の計算
-        m_hat = m / (1 - tf.math.pow(beta_1, iteration))
-        v_hat = v / (1 - tf.math.pow(beta_2, iteration))
+            # 勾配のある行のパラメータのみ更新する
+            variable.scatter_add( tf.IndexedSlices(update_rows, gradient.indices) )
+            return
 
-        # パラメータは assign 関数で更新する
-        variable.assign( variable - learning_rate * m_hat / (tf.math.sqrt(v_hat) + epsilon) )
+        # 密な勾配は, モーメントとパラメータを1つのカーネルでその場で更新する
+        # (ResourceApplyAdam の epsilon はバイアス補正後の値なので, epsilon_hat を渡すと同じ更新になる)
+        tf.raw_ops.ResourceApplyAdam(
+            var = variable.handle, m = m.handle, v = v.handle,
+            beta1_power = self._get_beta_power("beta_1", variable.dtype),
+            beta2_power = self._get_beta_power("beta_2", variable.dtype),
+            lr = self._get_hyper("learning_rate", variable.dtype), beta1 = beta_1, beta2 = beta_2,
+            epsilon = epsilon_hat, grad = gradient,
+        )
+
+    # 一次モーメントと二次モーメントを更新し, 更新後のモーメント (バイアス補正前) を返す
+    # 低精度のモーメントと lazy = False の疎な勾配の場合に用いる (LAMB では全ての場合に用いる)
+    def _update_moments(self, gradient, variable):
+        beta_1 = self._get_hyper("beta_1", variable.dtype)
+        beta_2 = self._get_hyper("beta_2", variable.dtype)
+        m, v = self._get_slots(variable)
+
+        if self._moment_dtype is not None:
+            # 低精度で保持しているモーメントは, 取り出してから functional と同じ更新式で更新する
+            m_value, v_value = adam_moments(
+                tf.convert_to_tensor(gradient), self._read_moment(m, variable), self._read_moment(v, variable, second = True),
+                beta_1, beta_2
+            )
+            self._write_moment(m, m_value)
+            self._write_moment(v, v_value, second = True)
+            return m_value, v_value
+
+        if isinstance(gradient, tf.IndexedSlices):
+            # モーメントを減衰させ, 勾配のある行にのみ勾配の項を加える
+            m.assign(beta_1 * m)
+            m.scatter_add(tf.IndexedSlices((1 - beta_1) * gradient.values, gradient.indices))
+            v.assign(beta_2 * v)
+            v.scatter_add(tf.IndexedSlices((1 - beta_2) * gradient.values * gradient.values, gradient.indices))
+            return m, v
+
+        # モーメントは functional と同じ更新式で求める
+        m_value, v_value = adam_moments(gradient, m, v, beta_1, beta_2)
+        m.assign(m_value)
+        v.assign(v_value)
+        return m_value, v_value
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を更新する
+    def _sharded_rule(self, gradient, param, slots):
+        m, v = slots
+        step_size, epsilon_hat = self._get_corrected_step(param.dtype)
+        return adam_rule(
+            gradient, m, v, self._get_hyper("beta_1", param.dtype), self._get_hyper("beta_2", param.dtype),
+            step_size, epsilon_hat
+        )
+
+    # Instrumentation で記録するモーメントの統計量
+    def _moment_statistics(self, var_list):
+        beta_2 = self._get_hyper("beta_2", tf.float32)
+        iteration = tf.cast(self.iterations, tf.float32)
+        v_hat = list()
+        for variable in var_list:
+            _, v = self._get_slots(variable)
+            if self._moment_dtype is not None:
+                v = self._read_moment(v, variable, second = True)
+            v_hat.append(tf.cast(v, tf.float32) / (1 - tf.math.pow(beta_2, iteration)))
+        return {
+            "v_hat_min": tf.reduce_min([tf.reduce_min(x) for x in v_hat]),
+            "v_hat_max": tf.reduce_max([tf.reduce_max(x) for x in v_hat]),
+        }
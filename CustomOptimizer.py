@@ -0,0 +1,923 @@
+import concurrent.futures
+import contextlib
+import functools
+import json
+import os
+import threading
+import weakref
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras import optimizers
+
+from Instrumentation import trace_update_step
+from functional import corrected_step
+
+# 各最適化手法に共通する処理をまとめた基底クラス
+# 各最適化手法は _build_slots 関数で保持する変数を作成し, _slot_names にその属性名を指定する
+#   保持する変数は _get_slots 関数で, _slot_names の順に取り出す
+#   ハイパーパラメータは _get_hyper 関数で, ステップごと, データ型ごとに1度だけキャストしたものを取り出す
+#   バイアス補正の項 1 - beta^t は _get_bias_correction 関数で, ステップごとに1度だけ計算したものを取り出す
+# 各最適化手法は register_keras_serializable でパッケージ "CustomOptimizers" に登録する
+#   (登録しないと, model.save で保存したモデルを読み込む際に Adam, SGD などの名前が Keras の最適化手法に解決される)
+class CustomOptimizer(optimizers.Optimizer):
+    # 保持する変数のリストの属性名
+    _slot_names = ()
+    # 保持する変数のうち, パラメータごとにスカラー (集団で学習する場合は [population_size]) のものの属性名
+    # shard_slots = True でも分割せず, 各最適化手法が作成する
+    _scalar_slot_names = ()
+    # 集団の大きさと, メンバーごとに値を持つハイパーパラメータの名前 (集団で学習する最適化手法のみ指定できる)
+    _population_size = None
+    _population_hyper_names = ()
+    # exploit_and_explore で perturb を掛けた値を収める範囲 (範囲を持つハイパーパラメータのみ. 名前: (下限, 上限))
+    _population_hyper_ranges = dict()
+    # モーメントを保持するデータ型 (Adam, AdaBelief のみ指定できる)
+    _moment_dtype = None
+    _block_size = 64
+    # 2次元以上の変数の二次モーメントを行と列の統計量に分解して保持するかどうか (AdaGrad, RMSprop のみ指定できる)
+    _factored = False
+    # shard_slots = True に対応しているかどうか (要素ごとの更新式 _sharded_rule を持つ最適化手法のみ)
+    _supports_sharding = False
+    # shard_slots = True で分散学習中に作成した場合の, 保持する変数の分割数 (レプリカの数)
+    _num_shards = None
+
+    # 各最適化手法は, 自身のハイパーパラメータ以外のキーワード引数を **kwargs でそのまま CustomOptimizer に渡す
+    #   fused, jit_compile, skip_nonfinite, accumulation_steps, instrumentation, averaging,
+    #   overlap, overlap_bucket_bytes, overlap_threads, shard_slots (残りは Keras の Optimizer に渡す)
+    def __init__(self, learning_rate, name, fused = False, jit_compile = True, skip_nonfinite = False, accumulation_steps = 1, instrumentation = None, averaging = None, overlap = False, overlap_bucket_bytes = 4 << 20, overlap_threads = None, shard_slots = False, **kwargs):
+        # jit_compile = True の場合, パラメータの更新を XLA でコンパイルする
+        super().__init__(name = name, jit_compile = jit_compile, **kwargs)
+        # 学習率の設定には _build_learning_rate 関数を用いる
+        self._learning_rate = self._build_learning_rate(learning_rate)
+        # fused = True の場合, 同じデータ型の変数をまとめて1度に更新する
+        if fused and type(self)._fused_update_step is CustomOptimizer._fused_update_step:
+            raise ValueError(f"`{self.__class__.__name__}` does not support `fused = True`.")
+        self._fused = fused
+        # skip_nonfinite = True の場合, 勾配に inf や nan が含まれるステップは更新を行わない
+        self._skip_nonfinite = skip_nonfinite
+        # accumulation_steps > 1 の場合, accumulation_steps 回分の勾配を累積してからパラメータを更新する
+        self._accumulation_steps = accumulation_steps
+        # instrumentation に Instrumentation を指定すると, 更新の統計量を記録する
+        self._instrumentation = instrumentation
+        # averaging に WeightAveraging を指定すると, パラメータの平均 (EMA, SWA) や Lookahead の遅い重みを保持する
+        self._averaging = averaging
+        # overlap = True の場合
+        #   tf.function の中: 各パラメータの更新を, 他のパラメータの勾配を待たずに始められるようにする (逆伝播と重なる)
+        #                     fused = True の場合も, 出力層側から overlap_bucket_bytes ごとのバケットに分けて連結する
+        #                     (変数ごとの更新は, もともと対応する勾配が求まった時点で実行できる)
+        #   Eager: 全ての勾配が求まった後, 変数ごとの更新を overlap_threads 個のスレッドで並列に適用する (逆伝播とは重ならない)
+        # skip_nonfinite, accumulation_steps, instrumentation は全ての勾配を待ってから判定するので, 併用すると重ならない
+        self._overlap = overlap
+        self._overlap_bucket_bytes = overlap_bucket_bytes
+        self._overlap_threads = overlap_threads
+        # shard_slots = True の場合, MirroredStrategy, MultiWorkerMirroredStrategy の下で保持する変数をレプリカの数に分割し,
+        # 各レプリカは自分の担当する部分のみを保持・更新してから, パラメータの更新量を all_gather で集める (ZeRO の stage 1)
+        self._shard_slots = shard_slots
+        # キャストしたハイパーパラメータとバイアス補正の項のキャッシュ
+        self._init_caches()
+
+    # 各最適化手法は super().get_config() にハイパーパラメータを追加する
+    # (instrumentation, averaging は保存しない. from_config は Keras の実装をそのまま用いる)
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "learning_rate": self._serialize_hyperparameter(self._learning_rate),
+            "fused": self._fused,
+            "skip_nonfinite": self._skip_nonfinite,
+            "accumulation_steps": self._accumulation_steps,
+            "overlap": self._overlap,
+            "overlap_bucket_bytes": self._overlap_bucket_bytes,
+            "overlap_threads": self._overlap_threads,
+            "shard_slots": self._shard_slots,
+        })
+        return config
+
+    # learning_rate 以外のスケジュールも復元できるようにする
+    @classmethod
+    def from_config(cls, config, custom_objects = None):
+        config = dict(config)
+        for name, value in config.items():
+            if name != "learning_rate" and isinstance(value, dict):
+                config[name] = tf.keras.optimizers.schedules.deserialize(value, custom_objects = custom_objects)
+        return super().from_config(config, custom_objects = custom_objects)
+
+    # LearningRateSchedule 以外の関数で指定したハイパーパラメータは, 現在のイテレーション数での値を保存する
+    def _serialize_hyperparameter(self, hyperparameter):
+        if callable(hyperparameter) and not isinstance(
+            hyperparameter, (tf.Variable, tf.keras.optimizers.schedules.LearningRateSchedule)
+        ):
+            return tf.convert_to_tensor(hyperparameter(self.iterations)).numpy()
+        return super()._serialize_hyperparameter(hyperparameter)
+
+    # build 関数は保持する変数を定義する関数
+    def build(self, var_list):
+
+        super().build(var_list)
+        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
+        if hasattr(self, "_built") and self._built:
+            return
+        self._built = True
+
+        # 低精度のパラメータには float32 のマスターコピーを用意し, 保持する変数はマスターコピーを参照して作成する
+        var_list = self._build_master_weights(var_list)
+        # 勾配を累積する変数
+        self._build_accumulators(var_list)
+        # パラメータの平均
+        self._build_averages(var_list)
+        # 各最適化手法で保持する変数 (shard_slots = True の分散学習中は, レプリカごとに分割して作成する)
+        if self._shard_slots and tf.distribute.has_strategy():
+            self._build_sharded_slots(var_list)
+        else:
+            self._build_slots(var_list)
+        # 変数から保持する変数を引く表
+        self._build_slot_table()
+
+    # 各最適化手法で保持する変数を作成する関数
+    # var_list は, 低精度のパラメータをマスターコピーに置き換えたリスト
+    def _build_slots(self, var_list):
+        pass
+
+    # 保持する変数を, パラメータを平坦にしてレプリカの数に分けた1つ分の大きさで, レプリカごとに別の値を持つ変数として作成する
+    # 初期値は全て0 (初期値がパラメータと同じ Momentum などは対応しない)
+    # 分割した変数はチェックポイントに含めず, export_state でパラメータと同じ形に集めて書き出す
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def _build_sharded_slots(self, var_list):
+        if not self._supports_sharding:
+            raise ValueError(f"`{self.__class__.__name__}` does not support `shard_slots = True`.")
+        if self._moment_dtype is not None or self._factored or self._population_size is not None:
+            raise ValueError("`shard_slots = True` cannot be used with `moment_dtype`, `factored` or `population_size`.")
+        if self._master_weights or self._accumulation_steps > 1 or self._instrumentation is not None:
+            raise ValueError(
+                "`shard_slots = True` cannot be used with low-precision variables, `accumulation_steps` or `instrumentation`."
+            )
+        self._num_shards = tf.distribute.get_strategy().num_replicas_in_sync
+        for name in self._slot_names:
+            if name in self._scalar_slot_names:
+                continue
+            slots = list()
+            for variable in var_list:
+                shard_size = -(-variable.shape.num_elements() // self._num_shards)
+                with tf.init_scope():
+                    slots.append(tf.Variable(
+                        tf.zeros([shard_size], dtype = variable.dtype), name = f"{name.lstrip('_')}_shard", trainable = False,
+                        synchronization = tf.VariableSynchronization.ON_READ, aggregation = tf.VariableAggregation.NONE,
+                    ))
+            setattr(self, name, slots)
+
+    # 平坦にしたテンソルの, replica_id 番目のレプリカが担当する部分 (最後のレプリカの余りは0で埋める)
+    def _local_shard(self, value, shard_size, replica_id):
+        value = tf.reshape(value, [-1])
+        value = tf.pad(value, [[0, shard_size * self._num_shards - value.shape.num_elements()]])
+        return tf.slice(value, [replica_id * shard_size], [shard_size])
+
+    # 各レプリカが担当する部分を集めて, variable と同じ形にする
+    def _gather_shards(self, shard, variable):
+        full = tf.distribute.get_replica_context().all_gather(shard, axis = 0)
+        return tf.reshape(full[:variable.shape.num_elements()], variable.shape)
+
+    # 保持する変数のうち, レプリカごとに分割したもの (マスターコピー, 勾配の累積, 平均は分割しない)
+    def _is_sharded(self, slot):
+        return self._num_shards is not None and slot.synchronization == tf.VariableSynchronization.ON_READ
+
+    # 保持する変数をパラメータと同じ形で読み出す (分割していない場合はそのまま返す)
+    def _read_slot(self, slot, variable):
+        if not self._is_sharded(slot):
+            return slot
+        # 分散学習のスコープの外 (export_state など) からも呼べるように, 変数を作成したスコープに入る
+        distribution = slot.distribute_strategy
+        with distribution.scope():
+            full = distribution.extended.call_for_each_replica(
+                lambda slot: self._gather_shards(tf.identity(slot), variable), args = (slot,)
+            )
+        return distribution.experimental_local_results(full)[0]
+
+    # パラメータと同じ形の値を, 分割した保持する変数に書き込む
+    def _write_slot(self, slot, variable, value):
+        if not self._is_sharded(slot):
+            slot.assign(value)
+            return
+        def assign(slot, value):
+            replica_id = tf.distribute.get_replica_context().replica_id_in_sync_group
+            slot.assign(self._local_shard(value, slot.shape[0], replica_id))
+        distribution = slot.distribute_strategy
+        with distribution.scope():
+            distribution.extended.call_for_each_replica(assign, args = (slot, tf.convert_to_tensor(value, slot.dtype)))
+
+    # 変数から保持する変数の組を1度の辞書の参照で取り出せるようにする
+    # (表はチェックポイントの依存関係に含めない)
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def _build_slot_table(self):
+        slot_lists = [getattr(self, name) for name in self._slot_names]
+        self._slot_table = {
+            var_key: tuple(slots[index] for slots in slot_lists)
+            for var_key, index in self._index_dict.items()
+        }
+
+    # 保持する変数を _slot_names の順に取り出す
+    def _get_slots(self, variable):
+        return self._slot_table[self._var_key(variable)]
+
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def _init_caches(self):
+        self._hyper_cache = dict()
+        # overlap = True の Eager では複数のスレッドからキャッシュを参照するので, 作成はロックを取って行う
+        # (_get_bias_correction などは内側で _get_hyper を呼ぶので, 同じスレッドから再び取れるロックにする)
+        self._hyper_cache_lock = threading.RLock()
+        # overlap = True の Eager での更新に用いるスレッドプール (初めて用いるときに作成し, close で終了する)
+        self._executor = None
+
+    # ステップごと, データ型ごとに1度だけ計算する値 (compute は dtype を受け取り値を返す関数)
+    # キャッシュはステップの初めに破棄し, グラフごとに別に保持する (tf.cond の分岐や XLA の関数から外側のテンソルを参照しない)
+    def _get_step_value(self, name, dtype, compute):
+        key = (name, tf.as_dtype(dtype), tf.compat.v1.get_default_graph())
+        value = self._hyper_cache.get(key)
+        if value is None:
+            with self._hyper_cache_lock:
+                value = self._hyper_cache.get(key)
+                if value is None:
+                    value = compute(dtype)
+                    self._hyper_cache[key] = value
+        return value
+
+    # ハイパーパラメータは, 値を変えても tf.function の再トレースが起きないように変数として保持する
+    # tf.Variable やスケジュール (LearningRateSchedule などステップ数を受け取る関数) を指定した場合はそのまま用いる
+    # 集団で学習する場合は, 各メンバーの値を並べた変数 [population_size] にする (値が1つの場合は全てのメンバーに同じ値を用いる)
+    def _build_hyperparameter(self, value, name):
+        if isinstance(value, tf.Variable) or callable(value):
+            return value
+        if self._population_size is not None:
+            value = tf.broadcast_to(tf.cast(value, tf.float32), [self._population_size])
+        # 学習率と同様に, 関数の外で変数を作成する
+        with tf.init_scope():
+            return tf.Variable(value, name = name, dtype = tf.float32, trainable = False)
+
+    # ハイパーパラメータの値. スケジュールの場合は step (既定では現在のイテレーション数) で評価する
+    def _get_hyper_value(self, name, step = None):
+        # 学習率にスケジュールを指定した場合は, Keras が計算したそのステップの学習率を用いる
+        value = self.learning_rate if name == "learning_rate" else getattr(self, f"_{name}")
+        if callable(value) and not isinstance(value, tf.Variable):
+            value = value(self.iterations if step is None else step)
+        return value
+
+    # ハイパーパラメータを dtype にキャストしたもの (スケジュールもステップごとに1度だけ評価する)
+    def _get_hyper(self, name, dtype):
+        return self._get_step_value(name, dtype, lambda dtype: tf.cast(self._get_hyper_value(name), dtype))
+
+    # beta^t (t は更新後のイテレーション数)
+    def _get_beta_power(self, name, dtype):
+        def compute(dtype):
+            iteration = tf.cast(self.iterations + 1, dtype)
+            return tf.math.pow(self._get_hyper(name, dtype), iteration)
+        return self._get_step_value(f"beta_power/{name}", dtype, compute)
+
+    # バイアス補正の項 1 - beta^t
+    def _get_bias_correction(self, name, dtype):
+        return self._get_step_value(
+            f"bias_correction/{name}", dtype, lambda dtype: 1 - self._get_beta_power(name, dtype)
+        )
+
+    # バイアス補正を学習率と epsilon に畳み込んだもの
+    #   learning_rate * m_hat / (sqrt(v_hat) + epsilon) = step_size * m / (sqrt(v) + epsilon_hat)
+    #   step_size = learning_rate * sqrt(1 - beta_2^t) / (1 - beta_1^t), epsilon_hat = epsilon * sqrt(1 - beta_2^t)
+    # m_hat, v_hat をパラメータと同じ大きさのテンソルとして作らずに済む
+    def _get_corrected_step(self, dtype):
+        def compute(dtype):
+            return corrected_step(
+                self._get_hyper("learning_rate", dtype), self._get_hyper("epsilon", dtype),
+                self._get_beta_power("beta_1", dtype), self._get_beta_power("beta_2", dtype)
+            )
+        return self._get_step_value("corrected_step", dtype, compute)
+
+    # 集団で学習する場合, パラメータは先頭の軸に各メンバーの値を並べたもの
+    def _check_population(self, var_list):
+        if self._population_size is None:
+            return
+        for variable in var_list:
+            if variable.shape.rank == 0 or variable.shape[0] != self._population_size:
+                raise ValueError(
+                    f"With `population_size = {self._population_size}`, every variable must have a leading "
+                    f"population axis of that size. Received: {variable.name} with shape {variable.shape}"
+                )
+
+    # ハイパーパラメータ [population_size] を, パラメータの先頭の軸に合わせて変形する
+    def _broadcast_population(self, value, variable):
+        if self._population_size is None:
+            return value
+        return tf.reshape(value, [-1] + [1] * (variable.shape.rank - 1))
+
+    # _get_hyper と同じく, ステップごと, データ型と形ごとに1度だけ計算したものを取り出す
+    def _get_population_hyper(self, name, variable):
+        value = self._get_hyper(name, variable.dtype)
+        if self._population_size is None:
+            return value
+        return self._get_step_value(
+            f"{name}/rank_{variable.shape.rank}", variable.dtype,
+            lambda dtype: self._broadcast_population(value, variable)
+        )
+
+    # 先読みした点でパラメータを保持する場合 (NAG, Nadian の shifted = True) の, 直前の更新で先読みに用いた mu を保持する変数を作成する
+    # mu を tf.Variable で指定して学習中に変えても, 本来のパラメータには先読みに用いた値で戻せる
+    # 初期値は今の mu (変化量の初期値は0なので, 最初の更新では値によらない)
+    def _add_look_ahead_mu(self, variable):
+        shape = [] if self._population_size is None else [self._population_size]
+        return self.add_variable_from_reference(
+            model_variable = variable, variable_name = "look_ahead_mu", shape = shape,
+            initial_value = tf.broadcast_to(tf.cast(self._get_hyper_value("mu"), variable.dtype), shape)
+        )
+
+    # Population Based Training の exploit と explore
+    # scores (大きいほど良い) が下位 fraction のメンバーを, 上位 fraction からランダムに選んだメンバーの
+    # パラメータ, 保持する変数, ハイパーパラメータで置き換え, ハイパーパラメータに perturb のいずれかを掛ける
+    # 掛けた値は _population_hyper_ranges の範囲に収める (mu が1以上になると発散するので)
+    # グラフ内でも実行できる. 戻り値は各メンバーのコピー元のインデックス
+    def exploit_and_explore(self, scores, var_list, fraction = 0.25, perturb = (0.8, 1.2), seed = None):
+        if self._population_size is None:
+            raise ValueError("`exploit_and_explore` requires `population_size` to be set.")
+        population_size = self._population_size
+        num_replaced = max(1, int(population_size * fraction))
+
+        order = tf.argsort(tf.convert_to_tensor(scores))
+        bottom = order[:num_replaced]
+        top = order[population_size - num_replaced:]
+        # 置き換えるメンバーごとに, コピー元の上位のメンバーを選ぶ
+        chosen = tf.gather(top, tf.random.uniform([num_replaced], maxval = num_replaced, dtype = tf.int32, seed = seed))
+        source = tf.tensor_scatter_nd_update(tf.range(population_size), bottom[:, None], chosen)
+
+        # 先読みした点で保持している場合 (Nadian の shifted = True) は, 先読みに用いた mu もコピー元のものにするので,
+        # mu を変えても本来のパラメータはコピー元と同じになる (次の更新で先読みに用いた mu で戻してから, 変えた mu を用いる)
+        for variable in var_list:
+            variable.assign(tf.gather(variable, source))
+            for _, slot in self._named_slots(variable):
+                slot.assign(tf.gather(slot, source))
+
+        # 置き換えたメンバーのハイパーパラメータのみ perturb のいずれかを掛ける
+        perturb = tf.constant(perturb, dtype = tf.float32)
+        replaced = tf.scatter_nd(bottom[:, None], tf.ones([num_replaced], dtype = tf.bool), [population_size])
+        for name in self._population_hyper_names:
+            hyper = getattr(self, f"_{name}")
+            # スケジュールで指定したハイパーパラメータは置き換えない
+            if not isinstance(hyper, tf.Variable):
+                continue
+            factors = tf.gather(perturb, tf.random.uniform([num_replaced], maxval = len(perturb), dtype = tf.int32, seed = seed))
+            factors = tf.tensor_scatter_nd_update(tf.ones([population_size]), bottom[:, None], factors)
+            value = tf.gather(hyper, source) * factors
+            if name in self._population_hyper_ranges:
+                lower, upper = self._population_hyper_ranges[name]
+                value = tf.where(replaced, tf.clip_by_value(value, lower, upper), value)
+            hyper.assign(value)
+        return source
+
+    # moment_dtype でモーメントを保持するデータ型を指定する
+    #   None: パラメータと同じデータ型
+    #   "bfloat16": bfloat16 で保持する (確率的丸めを用い, 1ステップあたりの相対誤差は 2^-7 未満)
+    #   "int8": block_size 個ごとに 8bit に量子化して保持する
+    #           (誤差は一次モーメントがブロック内の絶対値の最大値の 1/127, 二次モーメントの平方根が 1/255 以下)
+    def _set_moment_dtype(self, moment_dtype, block_size):
+        if moment_dtype not in (None, "bfloat16", "int8"):
+            raise ValueError(
+                "`moment_dtype` must be one of None, 'bfloat16' or 'int8'. "
+                f"Received: moment_dtype={moment_dtype}"
+            )
+        if moment_dtype is not None and self._fused:
+            raise ValueError("`moment_dtype` cannot be used with `fused = True`.")
+        self._moment_dtype = moment_dtype
+        self._block_size = block_size
+
+    # モーメントを保持する変数を作成する
+    def _add_moment(self, variable, variable_name, second = False):
+        if self._moment_dtype is None:
+            return self.add_variable_from_reference(
+                model_variable = variable, variable_name = variable_name,
+                # 初期値は0
+                initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
+            )
+        name = f"{variable_name}/{variable._shared_name}"
+        # パラメータが分割して配置されている場合も, モーメントは同じデバイスに配置する
+        with self._distribution_strategy.extended.colocate_vars_with(variable):
+            if self._moment_dtype == "bfloat16":
+                return self.add_variable(shape = variable.shape, dtype = tf.bfloat16, name = name)
+            # int8 の場合は, ブロックごとに量子化した値とブロックごとのスケールを保持する
+            # 二次モーメントは平方根を符号なしで量子化する
+            num_blocks = -(-variable.shape.num_elements() // self._block_size)
+            quantized = self.add_variable(
+                shape = (num_blocks, self._block_size), dtype = tf.uint8 if second else tf.int8, name = name
+            )
+            scale = self.add_variable(shape = (num_blocks,), dtype = tf.float32, name = f"{name}/scale")
+        return (quantized, scale)
+
+    # 保持しているモーメントをパラメータと同じデータ型で取り出す
+    def _read_moment(self, moment, variable, second = False):
+        if self._moment_dtype == "bfloat16":
+            return tf.cast(moment, variable.dtype)
+        quantized, scale = moment
+        levels = 255.0 if second else 127.0
+        blocks = tf.cast(quantized, tf.float32) * (scale[:, None] / levels)
+        value = tf.reshape(tf.reshape(blocks, [-1])[:variable.shape.num_elements()], variable.shape)
+        if second:
+            value = value * value
+        return tf.cast(value, variable.dtype)
+
+    # モーメントを低精度に変換して保持する
+    def _write_moment(self, moment, value, second = False):
+        value = tf.cast(value, tf.float32)
+        if self._moment_dtype == "bfloat16":
+            # 減衰率が1に近いと通常の丸めでは値が変化しなくなるので, 確率的丸めを用いる
+            bits = tf.bitcast(value, tf.int32)
+            noise = tf.random.uniform(tf.shape(bits), minval = 0, maxval = 1 << 16, dtype = tf.int32)
+            bits = tf.bitwise.bitwise_and(bits + noise, -(1 << 16))
+            moment.assign(tf.cast(tf.bitcast(bits, tf.float32), tf.bfloat16))
+            return
+        quantized, scale = moment
+        value = tf.reshape(value, [-1])
+        if second:
+            value = tf.math.sqrt(value)
+        value = tf.pad(value, [[0, quantized.shape[0] * quantized.shape[1] - value.shape[0]]])
+        blocks = tf.reshape(value, quantized.shape)
+        absmax = tf.reduce_max(tf.abs(blocks), axis = 1)
+        if second:
+            # 切り上げることで二次モーメントを過小評価しないようにする
+            normalized = tf.math.ceil(tf.math.divide_no_nan(blocks, absmax[:, None]) * 255.0)
+            quantized.assign(tf.cast(tf.clip_by_value(normalized, 0.0, 255.0), tf.uint8))
+        else:
+            # 確率的丸めを用いて, 小さな値も平均的には保持されるようにする
+            normalized = tf.math.divide_no_nan(blocks, absmax[:, None]) * 127.0
+            normalized = tf.math.floor(normalized + tf.random.uniform(tf.shape(normalized)))
+            quantized.assign(tf.cast(tf.clip_by_value(normalized, -127.0, 127.0), tf.int8))
+        scale.assign(absmax)
+
+    # 二次モーメントを分解して保持する変数かどうか
+    def _is_factored(self, variable):
+        return self._factored and variable.shape.rank >= 2
+
+    # 二次モーメントを, 最後の2軸についての行ごとの平均と列ごとの平均の組で保持する変数を作成する
+    #   row: variable.shape[:-1], col: variable.shape[:-2] + variable.shape[-1:]
+    # N x M の行列の場合, 保持する要素数は N * M から N + M になる
+    def _add_factored_slot(self, variable, variable_name):
+        name = f"{variable_name}/{variable._shared_name}"
+        # パラメータが分割して配置されている場合も, 保持する変数は同じデバイスに配置する
+        with self._distribution_strategy.extended.colocate_vars_with(variable):
+            row = self.add_variable(shape = variable.shape[:-1], dtype = variable.dtype, name = f"{name}/row")
+            col = self.add_variable(
+                shape = variable.shape[:-2].concatenate(variable.shape[-1:]), dtype = variable.dtype, name = f"{name}/col"
+            )
+        return (row, col)
+
+    # 勾配の二乗の行ごとの平均と列ごとの平均
+    @staticmethod
+    def _factored_square(gradient):
+        square = gradient * gradient
+        return tf.reduce_mean(square, axis = -1), tf.reduce_mean(square, axis = -2)
+
+    # 行ごとの平均と列ごとの平均から, 二次モーメントを row ⊗ col / mean(row) として復元する
+    @staticmethod
+    def _reconstruct_factored(row, col):
+        row = tf.convert_to_tensor(row)
+        row = tf.math.divide_no_nan(row, tf.reduce_mean(row, axis = -1, keepdims = True))
+        return row[..., :, None] * tf.convert_to_tensor(col)[..., None, :]
+
+    # テンソルを1次元にして連結する
+    @staticmethod
+    def _flatten_concat(tensors):
+        return tf.concat([tf.reshape(tensor, [-1]) for tensor in tensors], axis = 0)
+
+    # 各テンソルのノルムを1つのベクトルにまとめて求める (信頼比を全ての変数について1度に計算できる)
+    # 二乗和は変数ごとの reduce_sum で求める. 連結したテンソルに対する unsorted_segment_sum は CPU では要素ごとの scatter になり,
+    # 大きな変数では数倍遅い (segment_sum は XLA でコンパイルできない)
+    @staticmethod
+    def _batched_norms(tensors):
+        return tf.math.sqrt(tf.stack([tf.reduce_sum(tensor * tensor) for tensor in tensors]))
+
+    # 連結したテンソルを variables のそれぞれの形に分割する
+    @staticmethod
+    def _split_like(value, variables):
+        sizes = [variable.shape.num_elements() for variable in variables]
+        return [tf.reshape(part, variable.shape) for part, variable in zip(tf.split(value, sizes), variables)]
+
+    # パラメータを更新する方法を選ぶ
+    #   shard_slots = True の分散学習中: 各レプリカが担当する部分のみを更新する
+    #   overlap = True の Eager: 変数ごとの更新をスレッドプールで並列に実行する
+    #   分散学習中, fused = False: Keras と同じく変数ごとに更新する
+    #   fused = True: 同じデータ型の変数を連結して1度の演算で更新する
+    def _dispatch_apply_gradients(self, distribution, grads_and_vars, **kwargs):
+        # 保持する変数を分割している場合は, 各レプリカが担当する部分のみを更新する
+        if self._num_shards is not None:
+            return self._apply_gradients_sharded(distribution, grads_and_vars)
+        # overlap = True の Eager では, 変数ごとの更新をスレッドプールで並列に実行する
+        if self._overlap and tf.executing_eagerly() and not tf.distribute.has_strategy():
+            return self._apply_gradients_threaded(grads_and_vars)
+        # 分散学習中は変数ごとの更新を用いる
+        if not self._fused or tf.distribute.has_strategy():
+            return super()._distributed_apply_gradients_fn(distribution, grads_and_vars, **kwargs)
+
+        # データ型ごとに勾配とパラメータをまとめる
+        # overlap = True の場合は, 先に勾配が求まる出力層側のパラメータから並べる
+        buckets = dict()
+        for gradient, variable in (reversed(grads_and_vars) if self._overlap else grads_and_vars):
+            # 疎な勾配やマスターコピーを持つパラメータは連結せず, 変数ごとに更新する
+            if isinstance(gradient, tf.IndexedSlices) or self._var_key(variable) in self._master_weights:
+                self._update_step(gradient, variable)
+                continue
+            buckets.setdefault(variable.dtype, list()).append((gradient, variable))
+        for bucket in buckets.values():
+            for chunk in self._split_bucket(bucket):
+                gradients, variables = zip(*chunk)
+                with trace_update_step(self.name):
+                    self._fused_update_step(gradients, variables)
+
+        return self.iterations.assign_add(1)
+
+    # overlap = True の場合, バケットを overlap_bucket_bytes ごとに分け,
+    # 各バケットの更新がそのバケットの勾配のみを待つようにする
+    def _split_bucket(self, bucket):
+        if not self._overlap:
+            return [bucket]
+        chunks = list()
+        chunk_bytes = 0
+        for gradient, variable in bucket:
+            size = variable.shape.num_elements() * variable.dtype.size
+            if not chunks or chunk_bytes + size > self._overlap_bucket_bytes:
+                chunks.append(list())
+                chunk_bytes = 0
+            chunks[-1].append((gradient, variable))
+            chunk_bytes += size
+        return chunks
+
+    # 変数ごとの更新を, 出力層側のパラメータから順にスレッドプールで実行する
+    # Eager では apply_gradients を呼ぶ時点で全ての勾配が求まっているので, 逆伝播とは重ならず, 更新どうしを並列に適用する
+    # Eager の演算は実行中に GIL を解放するので, 複数のコアで同時に更新できる
+    def _apply_gradients_threaded(self, grads_and_vars):
+        executor = self._get_executor()
+
+        def update(gradient, variable):
+            if self.jit_compile:
+                return self._update_step_xla(gradient, variable, id(self._var_key(variable)))
+            return self._update_step(gradient, variable)
+
+        futures = [executor.submit(update, gradient, variable) for gradient, variable in reversed(grads_and_vars)]
+        for future in futures:
+            future.result()
+        return self.iterations.assign_add(1)
+
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers = self._overlap_threads, thread_name_prefix = f"{self.name}_update_step"
+            )
+            # close を呼ばずに最適化手法が破棄された場合もスレッドを終了する
+            weakref.finalize(self, self._executor.shutdown, wait = False)
+        return self._executor
+
+    # overlap = True の Eager で作成したスレッドプールを終了する (再び更新した場合は作成し直す)
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    # 同じデータ型の勾配とパラメータのリストを受け取り, まとめて更新する関数
+    def _fused_update_step(self, gradients, variables):
+        raise NotImplementedError
+
+    # shard_slots = True の分散学習中の更新
+    # 各レプリカは勾配とパラメータのうち担当する部分から, 担当する部分の保持する変数と更新量を求める
+    # 更新量は all_gather で全てのレプリカに集め, 各レプリカのパラメータに加える
+    def _apply_gradients_sharded(self, distribution, grads_and_vars):
+        gradients, variables = zip(*grads_and_vars)
+        updates = distribution.extended.call_for_each_replica(
+            self._sharded_replica_updates, args = (list(gradients), list(variables))
+        )
+        for variable, update in zip(variables, updates):
+            distribution.extended.update(variable, lambda variable, update: variable.assign_add(update), args = (update,), group = False)
+        return self.iterations.assign_add(1)
+
+    # レプリカごとに実行する部分. 戻り値は各パラメータの更新量 (パラメータと同じ形)
+    def _sharded_replica_updates(self, gradients, variables):
+        replica_id = tf.distribute.get_replica_context().replica_id_in_sync_group
+        updates = list()
+        for gradient, variable in zip(gradients, variables):
+            slots = self._get_slots(variable)
+            shard_size = -(-variable.shape.num_elements() // self._num_shards)
+            # 疎な勾配は密にしてから分割する
+            gradient = self._local_shard(tf.convert_to_tensor(gradient), shard_size, replica_id)
+            param = self._local_shard(variable, shard_size, replica_id)
+            with trace_update_step(self.name):
+                update, values = self._sharded_rule(gradient, param, slots)
+                for slot, value in zip(slots, values):
+                    slot.assign(value)
+            updates.append(self._gather_shards(update, variable))
+        return updates
+
+    # 平坦にした勾配, パラメータ, 保持する変数の担当する部分から, (パラメータに加える更新量, 更新後の保持する変数) を求める
+    # functional の更新式を用いる (shard_slots = True に対応する最適化手法で定義する)
+    # 更新後の保持する変数は _slot_names の先頭から返す (分割しないスカラーの保持する変数は返さず, レプリカの外で更新する)
+    def _sharded_rule(self, gradient, param, slots):
+        raise NotImplementedError
+
+    # 低精度 (float16, bfloat16) のパラメータに対して float32 のマスターコピーを作成する
+    # Keras の mixed_float16, mixed_bfloat16 ポリシーではパラメータ自体が float32 で, 計算時のみキャストされるので,
+    # マスターコピーは作成しない (パラメータがそのままマスターコピーの役割を果たす)
+    # 戻り値は, 保持する変数を作成する際に参照する変数のリスト
+    @tf.__internal__.tracking.no_automatic_dependency_tracking
+    def _build_master_weights(self, var_list):
+        self._master_weights = dict()
+        reference_list = list()
+        for variable in var_list:
+            if variable.dtype not in (tf.float16, tf.bfloat16):
+                reference_list.append(variable)
+                continue
+            # パラメータが分割して配置されている場合も, マスターコピーは同じデバイスに配置する
+            with self._distribution_strategy.extended.colocate_vars_with(variable):
+                master = self.add_variable(
+                    shape = variable.shape, dtype = tf.float32,
+                    # 初期値はパラメータと同じにする
+                    initializer = lambda shape, dtype, variable = variable: tf.cast(variable, dtype),
+                    name = f"master/{variable._shared_name}"
+                )
+            # マスターコピーからも保持する変数を取得できるようにする
+            self._index_dict[self._var_key(master)] = self._index_dict[self._var_key(variable)]
+            self._master_weights[self._var_key(variable)] = master
+            reference_list.append(master)
+        return reference_list
+
+    def _update_step(self, gradient, variable):
+        # プロファイラ上で最適化手法の処理として区別できるようにする
+        with trace_update_step(self.name):
+            master = self._master_weights.get(self._var_key(variable))
+            if master is None:
+                return super()._update_step(gradient, variable)
+            # float32 のマスターコピーを更新してから, 低精度のパラメータに反映する
+            super()._update_step(tf.cast(gradient, tf.float32), master)
+            variable.assign(tf.cast(master, variable.dtype))
+
+    # accumulation_steps > 1 の場合, 勾配を累積する変数を作成する
+    def _build_accumulators(self, var_list):
+        self._accumulators = list()
+        if self._accumulation_steps == 1:
+            return
+        # 勾配を累積した回数
+        self._accumulation_count = self.add_variable(shape = (), dtype = tf.int64, name = "accumulation_count")
+        for variable in var_list:
+            self._accumulators.append(
+                self.add_variable_from_reference(
+                    model_variable = variable, variable_name = "accumulator"
+                )
+            )
+
+    @staticmethod
+    def _accumulate(accumulator, gradient):
+        if isinstance(gradient, tf.IndexedSlices):
+            accumulator.scatter_add(tf.IndexedSlices(tf.cast(gradient.values, accumulator.dtype), gradient.indices))
+        else:
+            accumulator.assign_add(tf.cast(gradient, accumulator.dtype))
+
+    # 勾配を累積し, accumulation_steps 回に1度だけ累積した勾配の平均でパラメータを更新する
+    # Python 側での分岐は行わないので, グラフ内でそのまま実行できる
+    def _apply_accumulated_gradients(self, apply_gradients, distribution, grads_and_vars, **kwargs):
+        accumulators = [
+            self._accumulators[self._index_dict[self._var_key(variable)]] for _, variable in grads_and_vars
+        ]
+        for accumulator, (gradient, _) in zip(accumulators, grads_and_vars):
+            # 分散学習中も各デバイスの変数を更新できるように extended.update を用いる
+            distribution.extended.update(accumulator, self._accumulate, args = (gradient,), group = False)
+        count = self._accumulation_count.assign_add(1)
+
+        def apply_accumulated_gradients():
+            accumulated = [
+                (accumulator / tf.cast(self._accumulation_steps, accumulator.dtype), variable)
+                for accumulator, (_, variable) in zip(accumulators, grads_and_vars)
+            ]
+            # self.iterations はパラメータを更新したときのみ増える
+            iterations = apply_gradients(distribution, accumulated, **kwargs)
+            # 累積した勾配をリセット
+            for accumulator in accumulators:
+                accumulator.assign(tf.zeros_like(accumulator))
+            return tf.identity(iterations)
+
+        return tf.cond(
+            count % self._accumulation_steps == 0,
+            apply_accumulated_gradients,
+            lambda: tf.identity(self.iterations),
+        )
+
+    # averaging を指定した場合のみ, パラメータの平均を保持する変数を作成する
+    # 平均はパラメータごとに1つのみで, 評価時の入れ替えもこの変数との交換で行う
+    def _build_averages(self, var_list):
+        self._averages = list()
+        if self._averaging is None:
+            return
+        # 単純平均に含めたパラメータの数
+        if self._averaging.mode == "swa":
+            self._average_count = self.add_variable(shape = (), dtype = tf.int64, name = "average_count")
+        for variable in var_list:
+            self._averages.append(
+                self.add_variable_from_reference(
+                    model_variable = variable, variable_name = "average",
+                    # 初期値はパラメータと同じにする
+                    initial_value = variable
+                )
+            )
+
+    # 平均を取るパラメータ (マスターコピーがある場合はマスターコピー) と平均の組
+    def _get_average(self, variable):
+        var_key = self._var_key(variable)
+        return self._master_weights.get(var_key, variable), self._averages[self._index_dict[var_key]]
+
+    # with 文の中でのみ, パラメータを平均 (Lookahead の場合は遅い重み) に入れ替える
+    # パラメータと平均を交換するので, 評価のためにパラメータの複製を保持する必要は無い
+    @contextlib.contextmanager
+    def swap_average_weights(self, var_list):
+        if self._averaging is None:
+            raise ValueError("`swap_average_weights` requires `averaging` to be set.")
+        self._swap_averages(var_list)
+        try:
+            yield
+        finally:
+            self._swap_averages(var_list)
+
+    def _swap_averages(self, var_list):
+        for variable in var_list:
+            target, average = self._get_average(variable)
+            value = tf.identity(target)
+            target.assign(average)
+            average.assign(value)
+            if target is not variable:
+                variable.assign(tf.cast(target, variable.dtype))
+
+    # skip_nonfinite = True の場合, 勾配に inf や nan が含まれるステップは更新を行わない
+    # 判定はグラフ内で行うので, ホストとの同期は発生しない
+    # (LossScaleOptimizer でラップする場合は, LossScaleOptimizer が同じ処理を行う)
+    def _distributed_apply_gradients_fn(self, distribution, grads_and_vars, **kwargs):
+        # キャストしたハイパーパラメータはステップごとに計算し直す
+        self._hyper_cache.clear()
+
+        apply_gradients = self._dispatch_apply_gradients
+        if self._averaging is not None:
+            apply_gradients = functools.partial(self._averaging.apply, self, apply_gradients)
+        if self._instrumentation is not None:
+            apply_gradients = functools.partial(self._instrumentation.apply, self, apply_gradients)
+        if self._accumulation_steps > 1:
+            apply_gradients = functools.partial(self._apply_accumulated_gradients, apply_gradients)
+        if not self._skip_nonfinite:
+            return apply_gradients(distribution, grads_and_vars, **kwargs)
+
+        gradients = [gradient for gradient, _ in grads_and_vars]
+        if tf.distribute.in_cross_replica_context():
+            # 勾配はレプリカ間で集約済みなので, 判定結果はどのレプリカでも同じになる
+            is_finite = distribution.extended.call_for_each_replica(self._all_finite, args = (gradients,))
+            is_finite = distribution.experimental_local_results(is_finite)[0]
+        else:
+            # LossScaleOptimizer でラップした場合は, レプリカのコンテキストから呼び出される
+            is_finite = self._all_finite(gradients)
+        return tf.cond(
+            is_finite,
+            lambda: tf.identity(apply_gradients(distribution, grads_and_vars, **kwargs)),
+            lambda: tf.identity(self.iterations),
+        )
+
+    @staticmethod
+    def _all_finite(gradients):
+        return tf.reduce_all([
+            tf.reduce_all(tf.math.is_finite(
+                gradient.values if isinstance(gradient, tf.IndexedSlices) else gradient
+            ))
+            for gradient in gradients
+        ])
+
+    # パラメータに対応する保持する変数を, 名前と組にして返す
+    # 名前はパラメータの並び順によらないので, パラメータの追加や削除の後も対応を取り直せる
+    def _named_slots(self, variable):
+        var_key = self._var_key(variable)
+        named_slots = list()
+        master = self._master_weights.get(var_key)
+        if master is not None:
+            named_slots.append(("master", master))
+        if self._accumulators:
+            named_slots.append(("accumulator", self._accumulators[self._index_dict[var_key]]))
+        if self._averages:
+            named_slots.append(("average", self._averages[self._index_dict[var_key]]))
+        for slot_name, slot in zip(self._slot_names, self._get_slots(variable)):
+            slot_name = slot_name.lstrip("_")
+            # int8 で保持するモーメントは量子化した値とスケールの組, 分解した二次モーメントは行と列の統計量の組
+            if isinstance(slot, tuple):
+                named_slots.extend((f"{slot_name}/{i}", part) for i, part in enumerate(slot))
+            else:
+                named_slots.append((slot_name, slot))
+        return named_slots
+
+    # 変数として保持するハイパーパラメータを, 名前と組にして返す
+    # (集団で学習する場合の各メンバーの値や, exploit_and_explore で変えた値も含む. スケジュールは含まない)
+    def _named_hyperparameters(self):
+        named_hyperparameters = list()
+        if isinstance(self._learning_rate, tf.Variable):
+            named_hyperparameters.append(("learning_rate", self._learning_rate))
+        for name in self.get_config():
+            hyper = getattr(self, f"_{name}", None)
+            if name != "learning_rate" and isinstance(hyper, tf.Variable):
+                named_hyperparameters.append((name, hyper))
+        return named_hyperparameters
+
+    # 保持する変数を directory に書き出す
+    #   index.json: 最適化手法の設定, イテレーション数, 保持する変数とハイパーパラメータの一覧
+    #   00000.npy, ...: 保持する変数, 変数として保持するハイパーパラメータごとに1つのファイル
+    # 保持する変数はパラメータの名前 (variable.name) と保持する変数の名前で識別する
+    def export_state(self, directory, var_list):
+        self.build(var_list)
+        os.makedirs(directory, exist_ok = True)
+        entries = list()
+        names = set()
+        for variable in var_list:
+            if variable.name in names:
+                raise ValueError(
+                    f"Variable names must be unique to export the optimizer state. Received duplicate name: {variable.name}"
+                )
+            names.add(variable.name)
+            for slot_name, slot in self._named_slots(variable):
+                file_name = f"{len(entries):05d}.npy"
+                # 分割した保持する変数はパラメータと同じ形に集めて書き出すので, レプリカの数が変わっても復元できる
+                value = self._read_slot(slot, variable)
+                np.save(os.path.join(directory, file_name), self._slot_to_numpy(value))
+                entries.append({
+                    "variable": variable.name, "slot": slot_name,
+                    "shape": value.shape.as_list(), "dtype": slot.dtype.name, "file": file_name,
+                })
+        hyperparameters = list()
+        for name, hyper in self._named_hyperparameters():
+            file_name = f"{len(entries) + len(hyperparameters):05d}.npy"
+            np.save(os.path.join(directory, file_name), hyper.numpy())
+            hyperparameters.append({
+                "name": name, "shape": hyper.shape.as_list(), "dtype": hyper.dtype.name, "file": file_name,
+            })
+        index = {
+            "class_name": self.__class__.__name__,
+            "config": self.get_config(),
+            "iterations": int(self.iterations.numpy()),
+            "slots": entries,
+            "hyperparameters": hyperparameters,
+        }
+        if self._accumulation_steps > 1:
+            index["accumulation_count"] = int(self._accumulation_count.numpy())
+        if self._averages and self._averaging.mode == "swa":
+            index["average_count"] = int(self._average_count.numpy())
+        with open(os.path.join(directory, "index.json"), "w") as f:
+            # 変数で指定したハイパーパラメータは numpy の値になっている
+            json.dump(index, f, indent = 2, default = lambda value: value.tolist())
+
+    # export_state で書き出した保持する変数と, 変数として保持するハイパーパラメータを読み込む
+    # ファイルはメモリマップで開くので, 読み込むのは対応するパラメータがある変数のみ
+    # 名前, 形, データ型が一致しない変数は読み込まず, 初期値のままにする
+    # ハイパーパラメータは "hyperparameters/<名前>" として戻り値に含める
+    # 戻り値は, 読み込んだ変数 (restored), 対応する値が無かった変数 (missing), 使われなかった値 (unused) の名前のリスト
+    def restore_state(self, directory, var_list):
+        self.build(var_list)
+        with open(os.path.join(directory, "index.json")) as f:
+            index = json.load(f)
+        entries = {(entry["variable"], entry["slot"]): entry for entry in index["slots"]}
+
+        restored = list()
+        missing = list()
+        for variable in var_list:
+            for slot_name, slot in self._named_slots(variable):
+                entry = entries.pop((variable.name, slot_name), None)
+                shape = variable.shape if self._is_sharded(slot) else slot.shape
+                if entry is None or entry["shape"] != shape.as_list() or entry["dtype"] != slot.dtype.name:
+                    missing.append(f"{variable.name}/{slot_name}")
+                    continue
+                value = np.load(os.path.join(directory, entry["file"]), mmap_mode = "r")
+                self._write_slot(slot, variable, self._slot_from_numpy(value, slot.dtype))
+                restored.append(f"{variable.name}/{slot_name}")
+
+        # 集団で学習する場合の各メンバーの値や, exploit_and_explore で変えた値を戻す
+        hyper_entries = {entry["name"]: entry for entry in index.get("hyperparameters", list())}
+        for name, hyper in self._named_hyperparameters():
+            entry = hyper_entries.pop(name, None)
+            if entry is None or entry["shape"] != hyper.shape.as_list() or entry["dtype"] != hyper.dtype.name:
+                missing.append(f"hyperparameters/{name}")
+                continue
+            hyper.assign(np.load(os.path.join(directory, entry["file"]), mmap_mode = "r"))
+            restored.append(f"hyperparameters/{name}")
+
+        self.iterations.assign(index["iterations"])
+        if self._accumulation_steps > 1 and "accumulation_count" in index:
+            self._accumulation_count.assign(index["accumulation_count"])
+        if self._averages and self._averaging.mode == "swa" and "average_count" in index:
+            self._average_count.assign(index["average_count"])
+        return {
+            "restored": restored,
+            "missing": missing,
+            "unused": [f"{variable_name}/{slot_name}" for variable_name, slot_name in entries]
+                + [f"hyperparameters/{name}" for name in hyper_entries],
+        }
+
+    # numpy には bfloat16 が無いので, ビット列を uint16 として保存する
+    @staticmethod
+    def _slot_to_numpy(slot):
+        if slot.dtype == tf.bfloat16:
+            return tf.bitcast(tf.convert_to_tensor(slot), tf.uint16).numpy()
+        return slot.numpy()
+
+    @staticmethod
+    def _slot_from_numpy(value, dtype):
+        if dtype == tf.bfloat16:
+            return tf.bitcast(tf.constant(value), tf.bfloat16)
+        return value
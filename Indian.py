@@ -1,23 +1,36 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
 
-class Indian(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.01, alpha = 0.5, beta = 0.1, name = "Indian"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._alpha = alpha
-        self._beta = beta
+from CustomOptimizer import CustomOptimizer
+from functional import indian_init, indian_rule
+
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class Indian(CustomOptimizer):
+    _slot_names = ("_y",)
+    _population_hyper_names = ("alpha", "beta")
+    _supports_sharding = True
+
+    def __init__(self, learning_rate = 0.01, alpha = 0.5, beta = 0.1, name = "Indian", population_size = None, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        # population_size を指定した場合, population_size 個のハイパーパラメータの組を1度に学習する
+        #   パラメータは先頭の軸に各メンバーの値を並べたもの, alpha, beta は各メンバーの値を並べたもの (値が1つの場合は共通)
+        #   exploit_and_explore で下位のメンバーを上位のメンバーで置き換えられる
+        self._population_size = population_size
+        self._alpha = self._build_hyperparameter(alpha, "alpha")
+        self._beta = self._build_hyperparameter(beta, "beta")
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "alpha": self._serialize_hyperparameter(self._alpha),
+            "beta": self._serialize_hyperparameter(self._beta),
+            "population_size": self._population_size,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
+        self._check_population(var_list)
         # 
         self._y = list()
         for variable in var_list:
@@ -25,28 +38,37 @@ class Indian(optimizers.Optimizer):
                 self.add_variable_from_reference(
                     model_variable = variable, variable_name = "y",
                     # 初期値は0
-                    initial_value = tf.zeros(shape = variable.shape)
+                    initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
                 )
             )
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        alpha = tf.cast(self._alpha, variable.dtype)
-        beta = tf.cast(self._beta, variable.dtype)
-
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", variable.dtype)
+        # 集団で学習する場合は, パラメータの先頭の軸に合わせて変形したものを取り出す
+        alpha = self._get_population_hyper("alpha", variable)
+        beta = self._get_population_hyper("beta", variable)
 
         # yを取得
-        y = self._y[self._index_dict[var_key]]
-        tmp_y = tf.where(self.iterations == 0, 
-                         (1/beta - alpha) * variable - beta * beta * gradient, 
-                         y)
+        y, = self._get_slots(variable)
+        # 初回のイテレーションのみ y を初期化する
+        # tf.where では毎回両方の値を計算してしまうので, tf.cond で一方のみ計算する
+        tmp_y = tf.cond(self.iterations == 0,
+                        lambda: indian_init(gradient, variable, alpha, beta),
+                        lambda: y.value())
         
-        # 更新前のパラメータを保持
-        tmp_variable = variable.value()
-        # パラメータは assign 関数で更新する
-        variable.assign( variable + learning_rate * ( ((1/beta) - alpha) * variable - (1/beta) * tmp_y - beta * gradient ) )
+        # 更新量と更新後の y は functional と同じ更新式で求める
+        # 先に求めておくことで, 更新前のパラメータを複製せずにその場で更新できる
+        update, (y_value,) = indian_rule(gradient, variable, tmp_y, learning_rate, alpha, beta)
+        # パラメータは assign_add 関数でその場で更新する
+        variable.assign_add( update )
         # yを更新
-        y.assign( tmp_y + learning_rate * ( ((1/beta) - alpha) * tmp_variable - (1/beta) * tmp_y ) )
+        y.assign( y_value )
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を更新する
+    def _sharded_rule(self, gradient, param, slots):
+        y, = slots
+        alpha = self._get_hyper("alpha", param.dtype)
+        beta = self._get_hyper("beta", param.dtype)
+        y = tf.cond(self.iterations == 0, lambda: indian_init(gradient, param, alpha, beta), lambda: y.value())
+        return indian_rule(gradient, param, y, self._get_hyper("learning_rate", param.dtype), alpha, beta)
@@ -0,0 +1,78 @@
+import contextlib
+
+import tensorflow as tf
+
+# 最適化手法の統計量を every_n_steps ステップごとに記録するクラス
+# 統計量はグラフ内で計算し, tf.summary (writer が None の場合は既定の writer) と callback に渡す
+#   gradient_norm: 勾配のノルム
+#   update_norm: パラメータの変化量のノルム
+#   update_ratio: パラメータの変化量のノルムとパラメータのノルムの比
+#   apply_seconds: パラメータの更新にかかった時間 (秒)
+#   その他, 最適化手法ごとのモーメントの統計量 (Adam の v_hat の最小値, 最大値など)
+class Instrumentation:
+    def __init__(self, every_n_steps = 100, writer = None, callback = None):
+        self.every_n_steps = every_n_steps
+        self.writer = writer
+        # callback(step, statistics) の形で呼び出される. statistics は名前と値 (numpy) の辞書
+        self.callback = callback
+
+    # 記録するステップのみ統計量を計算しながらパラメータを更新する
+    def apply(self, optimizer, apply_gradients, distribution, grads_and_vars, **kwargs):
+        return tf.cond(
+            optimizer.iterations % self.every_n_steps == 0,
+            lambda: tf.identity(self._apply_and_record(optimizer, apply_gradients, distribution, grads_and_vars, **kwargs)),
+            lambda: tf.identity(apply_gradients(distribution, grads_and_vars, **kwargs)),
+        )
+
+    def _apply_and_record(self, optimizer, apply_gradients, distribution, grads_and_vars, **kwargs):
+        # 分散学習中は, 最初のレプリカの値を用いる
+        gradients = [distribution.experimental_local_results(gradient)[0] for gradient, _ in grads_and_vars]
+        variables = [variable for _, variable in grads_and_vars]
+
+        old_values = [tf.identity(variable) for variable in variables]
+        with tf.control_dependencies(old_values):
+            start = tf.timestamp()
+        with tf.control_dependencies([start]):
+            iterations = apply_gradients(distribution, grads_and_vars, **kwargs)
+        with tf.control_dependencies([iterations]):
+            end = tf.timestamp()
+            new_values = [tf.identity(variable) for variable in variables]
+
+        update_norm = tf.linalg.global_norm([new - old for new, old in zip(new_values, old_values)])
+        statistics = {
+            "gradient_norm": tf.linalg.global_norm(gradients),
+            "update_norm": update_norm,
+            "update_ratio": tf.math.divide_no_nan(update_norm, tf.linalg.global_norm(new_values)),
+            "apply_seconds": end - start,
+        }
+        if hasattr(optimizer, "_moment_statistics"):
+            statistics.update(optimizer._moment_statistics(variables))
+        statistics = {name: tf.cast(value, tf.float32) for name, value in statistics.items()}
+
+        step = optimizer.iterations
+        with contextlib.ExitStack() as stack:
+            if self.writer is not None:
+                stack.enter_context(self.writer.as_default())
+            for name, value in statistics.items():
+                tf.summary.scalar(f"{optimizer.name}/{name}", value, step = step)
+
+        if self.callback is not None:
+            names = list(statistics.keys())
+            def callback(step, *values):
+                self.callback(int(step), {name: value.numpy() for name, value in zip(names, values)})
+                return 0
+            # callback の呼び出しは記録するステップのみ行う
+            done = tf.py_function(callback, [step] + list(statistics.values()), tf.int32)
+            with tf.control_dependencies([done]):
+                iterations = tf.identity(iterations)
+        return iterations
+
+# パラメータの更新に名前を付け, プロファイラ上で最適化手法の処理として区別できるようにする
+@contextlib.contextmanager
+def trace_update_step(name):
+    with tf.name_scope(f"{name}_update_step"):
+        if tf.executing_eagerly():
+            with tf.profiler.experimental.Trace(f"{name}_update_step"):
+                yield
+        else:
+            yield
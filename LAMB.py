@@ -0,0 +1,104 @@
+import re
+
+import tensorflow as tf
+
+from Adam import Adam
+from functional import adam_direction, adam_moments, lamb_update, trust_ratio
+
+# Adam の更新量に層ごとの信頼比 ||w|| / ||update|| を掛ける最適化手法 (大きなバッチサイズ向け)
+#   update = m_hat / (sqrt(v_hat) + epsilon) + weight_decay_rate * w
+#   w = w - learning_rate * (||w|| / ||update||) * update
+# 1次元以下の変数 (バイアスや正規化層のパラメータ) と, 名前が exclude_from_layer_adaptation の
+# いずれかの正規表現に一致する変数は, 信頼比と weight_decay_rate を用いず Adam と同じように更新する
+# fused = True (既定) の場合は, 全ての変数のノルムをまとめて求め, 信頼比を1度に計算する
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class LAMB(Adam):
+    # 信頼比にはパラメータ全体のノルムが必要なので, 保持する変数の分割には対応しない
+    _supports_sharding = False
+
+    def __init__(self, learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-6, weight_decay_rate = 0.0, exclude_from_layer_adaptation = None, name = "LAMB", fused = True, **kwargs):
+        super().__init__(learning_rate = learning_rate, beta_1 = beta_1, beta_2 = beta_2, epsilon = epsilon, name = name, fused = fused, **kwargs)
+        self._weight_decay_rate = self._build_hyperparameter(weight_decay_rate, "weight_decay_rate")
+        self._exclude_from_layer_adaptation = exclude_from_layer_adaptation
+
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "weight_decay_rate": self._serialize_hyperparameter(self._weight_decay_rate),
+            "exclude_from_layer_adaptation": self._exclude_from_layer_adaptation,
+        })
+        # lazy は用いない
+        config.pop("lazy")
+        return config
+
+    # 信頼比を用いる変数かどうか
+    def _use_layer_adaptation(self, variable):
+        if variable.shape.rank <= 1:
+            return False
+        for pattern in self._exclude_from_layer_adaptation or list():
+            if re.search(pattern, variable.name) is not None:
+                return False
+        return True
+
+    # m_hat / (sqrt(v_hat) + epsilon) = scale * m / (sqrt(v) + epsilon_hat) の scale
+    def _get_direction_scale(self, dtype):
+        def compute(dtype):
+            return tf.math.sqrt(self._get_bias_correction("beta_2", dtype)) / self._get_bias_correction("beta_1", dtype)
+        return self._get_step_value("direction_scale", dtype, compute)
+
+    # 分散学習中や, 疎な勾配, マスターコピーを持つパラメータの場合は変数ごとに更新する
+    def update_step(self, gradient, variable):
+        _, epsilon_hat = self._get_corrected_step(variable.dtype)
+
+        # Adam と同じようにモーメントを更新
+        m, v = self._update_moments(gradient, variable)
+        # 更新量は functional と同じ更新式で求め, パラメータは assign_add 関数でその場で更新する
+        variable.assign_add( lamb_update(
+            variable, m, v, self._get_hyper("learning_rate", variable.dtype),
+            self._get_direction_scale(variable.dtype), epsilon_hat,
+            self._get_hyper("weight_decay_rate", variable.dtype), self._use_layer_adaptation(variable)
+        ) )
+
+    # Adam は fused = True に対応しないが, LAMB は全ての変数のノルムをまとめて求めるために連結して更新する
+    def _fused_update_step(self, gradients, variables):
+        dtype = variables[0].dtype
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        beta_1 = self._get_hyper("beta_1", dtype)
+        beta_2 = self._get_hyper("beta_2", dtype)
+        learning_rate = self._get_hyper("learning_rate", dtype)
+        weight_decay_rate = self._get_hyper("weight_decay_rate", dtype)
+        _, epsilon_hat = self._get_corrected_step(dtype)
+
+        m_list, v_list = zip(*[self._get_slots(variable) for variable in variables])
+
+        # 勾配とモーメントをそれぞれ1つのテンソルに連結
+        gradient = self._flatten_concat(gradients)
+        m = self._flatten_concat(m_list)
+        v = self._flatten_concat(v_list)
+
+        # 一次モーメントと二次モーメントを, 変数ごとの更新と同じ更新式で更新
+        m, v = adam_moments(gradient, m, v, beta_1, beta_2)
+        update = self._get_direction_scale(dtype) * adam_direction(m, v, epsilon_hat)
+
+        # 分割して各変数に書き戻す
+        for x, value in zip(m_list, self._split_like(m, m_list)):
+            x.assign(value)
+        for x, value in zip(v_list, self._split_like(v, v_list)):
+            x.assign(value)
+
+        # 更新量は変数ごとに分割し, 信頼比を用いる変数のみ weight_decay_rate の項を加える
+        adapted = [self._use_layer_adaptation(variable) for variable in variables]
+        updates = [
+            update + weight_decay_rate * variable if use else update
+            for update, variable, use in zip(self._split_like(update, variables), variables, adapted)
+        ]
+
+        # 全ての変数のパラメータと更新量のノルムをまとめて求め, 信頼比を1度に計算する
+        weight_norm = self._batched_norms(variables)
+        update_norm = self._batched_norms(updates)
+        ratios = tf.unstack(tf.where(
+            tf.constant(adapted), trust_ratio(weight_norm, update_norm, weight_norm, update_norm), tf.ones_like(weight_norm)
+        ))
+        for variable, update, ratio in zip(variables, updates, ratios):
+            variable.assign_sub( learning_rate * ratio * update )
@@ -0,0 +1,75 @@
+import re
+
+import tensorflow as tf
+
+from Momentum import Momentum
+from functional import lars_gradient, lars_trust_ratio
+
+# Momentum の勾配に層ごとの信頼比を掛ける最適化手法 (大きなバッチサイズ向け)
+#   trust_ratio = eta * ||w|| / (||g|| + weight_decay_rate * ||w|| + epsilon)
+#   Momentum の勾配を trust_ratio * (g + weight_decay_rate * w) に置き換えて更新する
+# 1次元以下の変数 (バイアスや正規化層のパラメータ) と, 名前が exclude_from_layer_adaptation の
+# いずれかの正規表現に一致する変数は, 信頼比と weight_decay_rate を用いず Momentum と同じように更新する
+# fused = True (既定) の場合は, 全ての変数のノルムをまとめて求め, 信頼比を1度に計算する
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class LARS(Momentum):
+    def __init__(self, learning_rate = 0.1, mu = 0.9, eta = 0.001, weight_decay_rate = 0.0, epsilon = 1e-9, exclude_from_layer_adaptation = None, name = "LARS", fused = True, **kwargs):
+        super().__init__(learning_rate = learning_rate, mu = mu, name = name, fused = fused, **kwargs)
+        self._eta = self._build_hyperparameter(eta, "eta")
+        self._weight_decay_rate = self._build_hyperparameter(weight_decay_rate, "weight_decay_rate")
+        self._epsilon = self._build_hyperparameter(epsilon, "epsilon")
+        self._exclude_from_layer_adaptation = exclude_from_layer_adaptation
+
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "eta": self._serialize_hyperparameter(self._eta),
+            "weight_decay_rate": self._serialize_hyperparameter(self._weight_decay_rate),
+            "epsilon": self._serialize_hyperparameter(self._epsilon),
+            "exclude_from_layer_adaptation": self._exclude_from_layer_adaptation,
+        })
+        return config
+
+    # 信頼比を用いる変数かどうか
+    def _use_layer_adaptation(self, variable):
+        if variable.shape.rank <= 1:
+            return False
+        for pattern in self._exclude_from_layer_adaptation or list():
+            if re.search(pattern, variable.name) is not None:
+                return False
+        return True
+
+    # 信頼比. どちらかのノルムが0の場合は1にする (functional と同じ式)
+    def _trust_ratio(self, weight_norm, gradient_norm):
+        dtype = weight_norm.dtype
+        return lars_trust_ratio(
+            weight_norm, gradient_norm, self._get_hyper("eta", dtype),
+            self._get_hyper("weight_decay_rate", dtype), self._get_hyper("epsilon", dtype)
+        )
+
+    # 信頼比を掛けた勾配
+    def _scaled_gradient(self, gradient, variable, trust_ratio):
+        return lars_gradient(gradient, variable, trust_ratio, self._get_hyper("weight_decay_rate", variable.dtype))
+
+    # 分散学習中や, マスターコピーを持つパラメータの場合は変数ごとに更新する
+    def update_step(self, gradient, variable):
+        if self._use_layer_adaptation(variable):
+            gradient = tf.convert_to_tensor(gradient)
+            trust_ratio = self._trust_ratio(tf.norm(variable), tf.norm(gradient))
+            gradient = self._scaled_gradient(gradient, variable, trust_ratio)
+        super().update_step(gradient, variable)
+
+    # 全ての変数のノルムをまとめて求めてから, 変数ごとに Momentum と同じように更新する
+    def _fused_update_step(self, gradients, variables):
+        adapted = [self._use_layer_adaptation(variable) for variable in variables]
+        if any(adapted):
+            adapted_variables = [variable for variable, use in zip(variables, adapted) if use]
+            adapted_gradients = [gradient for gradient, use in zip(gradients, adapted) if use]
+            trust_ratios = iter(tf.unstack(self._trust_ratio(
+                self._batched_norms(adapted_variables), self._batched_norms(adapted_gradients)
+            )))
+        for gradient, variable, use in zip(gradients, variables, adapted):
+            if use:
+                gradient = self._scaled_gradient(gradient, variable, next(trust_ratios))
+            super().update_step(gradient, variable)
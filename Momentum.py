@@ -1,22 +1,26 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
 
-class Momentum(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.01, mu = 0.9, name = "Momentum"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._mu = mu
+from CustomOptimizer import CustomOptimizer
+from functional import momentum_rule
+
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class Momentum(CustomOptimizer):
+    _slot_names = ("_past_variables",)
+
+    def __init__(self, learning_rate = 0.01, mu = 0.9, name = "Momentum", **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        self._mu = self._build_hyperparameter(mu, "mu")
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "mu": self._serialize_hyperparameter(self._mu),
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
         # 過去のパラメータを保持する変数
         self._past_variables = list()
         for variable in var_list:
@@ -29,19 +33,22 @@ class Momentum(optimizers.Optimizer):
             )
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        mu = tf.cast(self._mu, variable.dtype)
-
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", variable.dtype)
+        mu = self._get_hyper("mu", variable.dtype)
 
         # 1イテレーション前のパラメータを取得
-        past_variable = self._past_variables[self._index_dict[var_key]]
+        past_variable, = self._get_slots(variable)
         
-        # 更新前のパラメータを保持
-        tmp_variable = variable.value()
-        # パラメータは assign 関数で更新する
-        variable.assign( variable + mu * (variable - past_variable) - learning_rate * gradient )
-        # 更新前のパラメータを更新
-        past_variable.assign( tmp_variable )
+        # 1イテレーションでのパラメータの変化量
+        velocity = variable - past_variable
+        # 過去のパラメータを更新前のパラメータに更新 (パラメータの複製は作らない)
+        past_variable.assign_add( velocity )
+        if isinstance(gradient, tf.IndexedSlices):
+            # 慣性の項は全体に加え, 勾配の項は勾配のある行にのみ加える
+            variable.assign_add( mu * velocity )
+            variable.scatter_sub( tf.IndexedSlices(learning_rate * gradient.values, gradient.indices) )
+        else:
+            # 更新量は functional と同じ更新式で求め, パラメータは assign_add 関数でその場で更新する
+            update, _ = momentum_rule(gradient, velocity, learning_rate, mu)
+            variable.assign_add( update )
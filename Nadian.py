@@ -1,36 +1,81 @@
+import contextlib
+import warnings
+
 import tensorflow as tf
-from tensorflow.keras import optimizers
-
-class Nadian(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.01, mu = 0.9, alpha = 0.5, beta = 0.1, name = "Nadian"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._mu = mu
-        self._alpha = alpha
-        self._beta = beta
+
+from CustomOptimizer import CustomOptimizer
+from functional import indian_rule
+
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class Nadian(CustomOptimizer):
+    _population_hyper_names = ("mu", "alpha", "beta")
+    # mu は1未満でないと発散する (alpha, beta は正の値を掛けるだけなので符号は変わらない)
+    _population_hyper_ranges = {"mu": (0.0, 0.999)}
+    _scalar_slot_names = ("_look_ahead_mus",)
+
+    def __init__(self, learning_rate = 0.01, mu = 0.9, alpha = 0.5, beta = 0.1, name = "Nadian", shifted = False, population_size = None, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        # population_size を指定した場合, population_size 個のハイパーパラメータの組を1度に学習する
+        #   パラメータは先頭の軸に各メンバーの値を並べたもの, mu, alpha, beta は各メンバーの値を並べたもの (値が1つの場合は共通)
+        #   exploit_and_explore で下位のメンバーを上位のメンバーで置き換えられる
+        self._population_size = population_size
+        self._mu = self._build_hyperparameter(mu, "mu")
+        self._alpha = self._build_hyperparameter(alpha, "alpha")
+        self._beta = self._build_hyperparameter(beta, "beta")
+        # shifted = True の場合, パラメータをネステロフの加速勾配を求める点 (先読みした点) で保持する
+        self._shifted = shifted
+        # shifted = False で Tensor の損失を受け取ったことを1度だけ警告する
+        self._warned_tensor_loss = False
+
+    @property
+    def _slot_names(self):
+        return ("_y", "_velocities", "_look_ahead_mus") if self._shifted else ("_y", "_past_variables")
+
+    # shard_slots = True は shifted = True のみ対応する (1イテレーション前のパラメータは初期値がパラメータと同じなので)
+    @property
+    def _supports_sharding(self):
+        return self._shifted
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "mu": self._serialize_hyperparameter(self._mu),
+            "alpha": self._serialize_hyperparameter(self._alpha),
+            "beta": self._serialize_hyperparameter(self._beta),
+            "shifted": self._shifted,
+            "population_size": self._population_size,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
+        self._check_population(var_list)
         # 
         self._y = list()
         # 1イテレーション前のパラメータを保持する変数
         self._past_variables = list()
+        # shifted = True の場合は, 1イテレーションでのパラメータの変化量と直前の更新で先読みに用いた mu を保持する
+        self._velocities = list()
+        self._look_ahead_mus = list()
         for variable in var_list:
             self._y.append(
                 self.add_variable_from_reference(
                     model_variable = variable, variable_name = "y",
                     # 初期値は0
-                    initial_value = tf.zeros(shape = variable.shape)
+                    initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
                 )
             )
+            if self._shifted:
+                self._velocities.append(
+                    self.add_variable_from_reference(
+                        model_variable = variable, variable_name = "velocity",
+                        # 初期値は0
+                        initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
+                    )
+                )
+                self._look_ahead_mus.append( self._add_look_ahead_mu(variable) )
+                continue
             self._past_variables.append(
                 self.add_variable_from_reference(
                     model_variable = variable, variable_name = "past_variable",
@@ -39,39 +84,62 @@ class Nadian(optimizers.Optimizer):
                 )
             )
     
+    # y と変化量は分割し, 先読みに用いた mu は分割せずに作成する
+    def _build_sharded_slots(self, var_list):
+        super()._build_sharded_slots(var_list)
+        self._look_ahead_mus = [self._add_look_ahead_mu(variable) for variable in var_list]
+
     # ネステロフの加速勾配を求めるように編集
     def compute_gradients(self, loss, var_list, tape=None):
-        # build関数を呼び出さないと保持する変数が定義されないので, ここで呼び出し
-        self.build(var_list)
+        # 先読みした点で保持している場合は, そのまま勾配を求めればネステロフの加速勾配になる
+        if self._shifted:
+            return super().compute_gradients(loss, var_list, tape)
 
-        if not callable(loss) and tape is None:
+        # 分散学習中はレプリカの中からパラメータを書き換えられないので, shifted = True を用いる必要がある
+        if tf.distribute.has_strategy():
             raise ValueError(
-                "`tape` is required when a `Tensor` loss is passed. "
-                f"Received: loss={loss}, tape={tape}."
+                f"`{self.__class__.__name__}` with `shifted = False` assigns the look-ahead point to the model "
+                "variables, which is not supported under a `tf.distribute` strategy. "
+                "Use `shifted = True` instead."
             )
-        if tape is None:
-            tape = tf.GradientTape()
-        if callable(loss):
-            with tape:
-                if not callable(var_list):
-                    tape.watch(var_list)
-                loss = loss()
-                if callable(var_list):
-                    var_list = var_list()
+
+        # 計算済みの Tensor の損失 (model.fit など) は先読みした点で計算し直せないので, tape から今の点での勾配を求める
+        # この場合の更新は先読みを行わない Indian と同じになる
+        if not callable(loss):
+            if not self._warned_tensor_loss:
+                self._warned_tensor_loss = True
+                warnings.warn(
+                    f"`{self.__class__.__name__}` with `shifted = False` received a `Tensor` loss, so the gradient is "
+                    "taken at the current point instead of the look-ahead point. "
+                    "Pass a callable loss, or use `shifted = True` (e.g. with `model.fit`).",
+                    stacklevel = 2,
+                )
+            return super().compute_gradients(loss, var_list, tape)
+        if callable(var_list):
+            var_list = var_list()
+
+        # build関数を呼び出さないと保持する変数が定義されないので, ここで呼び出し
+        self.build(var_list)
         
         # ネステロフの加速勾配の形にパラメータを変更
         tmp_variables = list()
         for variable in var_list:
-            var_key = self._var_key(variable)
-            past_variable = self._past_variables[self._index_dict[var_key]]
-            mu = tf.cast(self._mu, variable.dtype)
+            _, past_variable = self._get_slots(variable)
+            # マスターコピーがある場合は, マスターコピーから計算する
+            source = self._master_weights.get(self._var_key(variable), variable)
+            mu = self._broadcast_population(tf.cast(self._get_hyper_value("mu"), source.dtype), source)
 
             # 今のパラメータを保持
             tmp_variables.append( variable.value() )
             # パラメータをネステロフの加速勾配の形に変更
-            variable.assign(variable + mu * (variable - past_variable))
+            variable.assign(tf.cast(source + mu * (source - past_variable), variable.dtype))
 
-        # ネステロフの加速勾配    
+        # 先読みした点で損失を求め, ネステロフの加速勾配を求める
+        if tape is None:
+            tape = tf.GradientTape()
+        with tape:
+            tape.watch(var_list)
+            loss = loss()
         grads = tape.gradient(loss, var_list)
 
         # パラメータを元の形に変更
@@ -81,23 +149,95 @@ class Nadian(optimizers.Optimizer):
         return list(zip(grads, var_list))
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        alpha = tf.cast(self._alpha, variable.dtype)
-        beta = tf.cast(self._beta, variable.dtype)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", variable.dtype)
+        # 集団で学習する場合は, パラメータの先頭の軸に合わせて変形したものを取り出す
+        alpha = self._get_population_hyper("alpha", variable)
+        beta = self._get_population_hyper("beta", variable)
 
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        if self._shifted:
+            # y, パラメータの変化量と, 直前の更新で先読みに用いた mu を取得
+            y, velocity, look_ahead_mu = self._get_slots(variable)
+            mu = self._get_population_hyper("mu", variable)
+            # 先読みした点から本来のパラメータを求める (mu を変えた場合も, 先読みに用いた mu で戻す)
+            true_variable = variable - self._shift(variable)
+            # 次のイテレーションの先読みには今のステップの mu を用いる
+            look_ahead_mu.assign( tf.broadcast_to(self._get_hyper("mu", variable.dtype), look_ahead_mu.shape) )
+            # 本来のパラメータの変化量と更新後の y は, functional と同じく Indian の更新式で求める
+            delta, (y_value,) = indian_rule(gradient, true_variable, y, learning_rate, alpha, beta)
+            # yを更新
+            y.assign( y_value )
+            # 次のイテレーションの先読みした点にパラメータを更新
+            # (先読みした点から戻すには, 今のステップではなく先読みに用いた mu を用いる)
+            variable.assign( true_variable + (1 + mu) * delta )
+            # 変化量を更新
+            velocity.assign( delta )
+            return
 
-        # yを取得
-        y = self._y[self._index_dict[var_key]]
-        past_variable = self._past_variables[self._index_dict[var_key]]
+        # yと1イテレーション前のパラメータを取得
+        y, past_variable = self._get_slots(variable)
         
-        # 更新前のパラメータを保持
-        tmp_variable = variable.value()
-        # パラメータは assign 関数で更新する
-        variable.assign( variable + learning_rate * ( ((1/beta) - alpha) * variable - (1/beta) * y - beta * gradient ) )
-        # yを更新
-        y.assign( y + learning_rate * ( ((1/beta) - alpha) * tmp_variable - (1/beta) * y ) )
+        # 更新量と更新後の y は Indian と同じ更新式で求める
+        # 先に求めておくことで, 更新前のパラメータを複製せずにその場で更新できる
+        update, (y_value,) = indian_rule(gradient, variable, y, learning_rate, alpha, beta)
         # 1イテレーション前のパラメータを更新
-        past_variable.assign( tmp_variable )
+        past_variable.assign( variable )
+        # パラメータは assign_add 関数でその場で更新する
+        variable.assign_add( update )
+        # yを更新
+        y.assign( y_value )
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を update_step の shifted = True と同じように更新する
+    def _sharded_rule(self, gradient, param, slots):
+        y, velocity, look_ahead_mu = slots
+        mu = self._get_hyper("mu", param.dtype)
+        # 先読みに用いた mu で本来のパラメータに戻す (先読みに用いた mu は _apply_gradients_sharded で更新する)
+        shift = tf.cast(look_ahead_mu, param.dtype) * velocity
+        true_param = param - shift
+        delta, (y,) = indian_rule(
+            gradient, true_param, y, self._get_hyper("learning_rate", param.dtype),
+            self._get_hyper("alpha", param.dtype), self._get_hyper("beta", param.dtype)
+        )
+        # 本来のパラメータに戻してから, 次のイテレーションの先読みした点に進める
+        return (1 + mu) * delta - shift, (y, delta)
+
+    # shard_slots = True の場合, 各レプリカの更新の後に先読みに用いた mu を今のステップの値に更新する
+    # (分割しない変数はレプリカの中から書き換えられないので)
+    def _apply_gradients_sharded(self, distribution, grads_and_vars):
+        mu = tf.identity(self._get_hyper_value("mu"))
+        iterations = super()._apply_gradients_sharded(distribution, grads_and_vars)
+        for _, variable in grads_and_vars:
+            _, _, look_ahead_mu = self._get_slots(variable)
+            distribution.extended.update(
+                look_ahead_mu, lambda look_ahead_mu, mu: look_ahead_mu.assign(tf.cast(mu, look_ahead_mu.dtype)), args = (mu,), group = False
+            )
+        return iterations
+
+    # 先読みした点と本来のパラメータとの差 (直前の更新で先読みに用いた mu で求める)
+    def _shift(self, variable):
+        _, velocity, look_ahead_mu = self._get_slots(variable)
+        # 保持する変数を分割している場合は, パラメータと同じ形に集める
+        velocity = self._read_slot(velocity, variable)
+        mu = self._broadcast_population(tf.cast(look_ahead_mu, velocity.dtype), velocity)
+        return tf.cast(mu * velocity, variable.dtype)
+
+    # 先読みした点で保持しているパラメータから, 本来のパラメータを求める
+    def true_value(self, variable):
+        if not self._shifted:
+            return variable.value()
+        return variable - self._shift(variable)
+
+    # 評価やチェックポイントの保存の間だけ, パラメータを本来の値に置き換える
+    @contextlib.contextmanager
+    def true_weights(self, var_list):
+        if not self._shifted:
+            yield
+            return
+        for variable in var_list:
+            variable.assign_sub( self._shift(variable) )
+        try:
+            yield
+        finally:
+            # 先読みした点に戻す
+            for variable in var_list:
+                variable.assign_add( self._shift(variable) )
@@ -1,47 +1,125 @@
 import tensorflow as tf
-from tensorflow.keras import optimizers
-
-class RMSprop(optimizers.Optimizer):
-    def __init__(self, learning_rate = 0.001, rho = 0.9, epsilon = 1e-7,name = "RMSprop"):
-        super().__init__(name = name)
-        # 学習率の設定には _build_learning_rate 関数を用いる
-        self._learning_rate = self._build_learning_rate(learning_rate)
-        self._rho = rho
-        self._epsilon = epsilon
+
+from CustomOptimizer import CustomOptimizer
+from functional import rmsprop_rule
+
+@tf.keras.utils.register_keras_serializable(package = "CustomOptimizers")
+class RMSprop(CustomOptimizer):
+    _slot_names = ("_v",)
+    _supports_sharding = True
+
+    def __init__(self, learning_rate = 0.001, rho = 0.9, epsilon = 1e-7,name = "RMSprop", factored = False, **kwargs):
+        super().__init__(learning_rate = learning_rate, name = name, **kwargs)
+        self._rho = self._build_hyperparameter(rho, "rho")
+        self._epsilon = self._build_hyperparameter(epsilon, "epsilon")
+        # factored = True の場合, 2次元以上の変数の二次モーメントを, 最後の2軸の行ごとと列ごとの移動平均のみで保持する
+        # 1次元以下の変数は, これまで通りパラメータと同じ形で保持する
+        if factored and self._fused:
+            raise ValueError("`factored` cannot be used with `fused = True`.")
+        self._factored = factored
     
-    # build 関数は保持する変数を定義する関数
-    def build(self, var_list):
-        
-        super().build(var_list)
-        # build 関数はイテレーション毎に呼び出されるので, 初めの1度のみ処理されるようにする
-        if hasattr(self, "_built") and self._built:
-            return
-        self._built = True
+    # ハイパーパラメータを保存できるようにする
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            "rho": self._serialize_hyperparameter(self._rho),
+            "epsilon": self._serialize_hyperparameter(self._epsilon),
+            "factored": self._factored,
+        })
+        return config
 
+    # 保持する変数を定義する関数
+    def _build_slots(self, var_list):
         # 二次モーメントを保持する変数
         self._v = list()
         for variable in var_list:
+            if self._is_factored(variable):
+                self._v.append(self._add_factored_slot(variable, "v"))
+                continue
             self._v.append(
                 self.add_variable_from_reference(
                     model_variable = variable, variable_name = "v",
                     # 初期値はパラメータと同じにする
-                    initial_value = tf.zeros(shape = variable.shape)
+                    initial_value = tf.zeros(shape = variable.shape, dtype = variable.dtype)
                 )
             )
     
     def update_step(self, gradient, variable):
-        # ハイパーパラメータはパラメータと同じデータ型にキャストする
-        learning_rate = tf.cast(self._learning_rate, variable.dtype)
-        rho = tf.cast(self._rho, variable.dtype)
-        epsilon = tf.cast(self._epsilon, variable.dtype)
-
-        # 保持する変数を取得するためのキー
-        var_key = self._var_key(variable)
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", variable.dtype)
+        rho = self._get_hyper("rho", variable.dtype)
+        epsilon = self._get_hyper("epsilon", variable.dtype)
 
         # 二次モーメントを取得
-        v = self._v[self._index_dict[var_key]]
+        v, = self._get_slots(variable)
+
+        if self._is_factored(variable):
+            # 疎な勾配は密にしてから, 行ごとと列ごとの移動平均をその場で更新する
+            gradient = tf.convert_to_tensor(gradient)
+            row, col = v
+            row_square, col_square = self._factored_square(gradient)
+            row.assign_add((1 - rho) * (row_square - row))
+            col.assign_add((1 - rho) * (col_square - col))
+            # 移動平均から二次モーメントを復元して更新する
+            v = self._reconstruct_factored(row, col)
+            variable.assign_sub( learning_rate * gradient / (tf.math.sqrt(v) + epsilon) )
+            return
+
+        if isinstance(gradient, tf.IndexedSlices):
+            # 二次モーメントを減衰させ, 勾配のある行にのみ勾配の項を加える
+            v.assign(rho * v)
+            v.scatter_add(tf.IndexedSlices((1 - rho) * gradient.values * gradient.values, gradient.indices))
+            # 勾配の無い行はパラメータが変化しないので, 勾配のある行のみ更新する
+            v_rows = tf.gather(v, gradient.indices)
+            variable.scatter_sub(
+                tf.IndexedSlices(learning_rate * gradient.values / (tf.math.sqrt(v_rows) + epsilon), gradient.indices)
+            )
+            return
         
-        # 二次モーメントを更新
-        v.assign(rho * v + (1 - rho) * gradient * gradient)
-        # パラメータは assign 関数で更新する
-        variable.assign( variable - learning_rate * gradient / (tf.math.sqrt(v) + epsilon) )
+        # 更新量と二次モーメントは functional と同じ更新式で求める
+        # ResourceApplyRMSProp は epsilon を平方根の中に加えるので用いない
+        update, (v_value,) = rmsprop_rule(gradient, v, learning_rate, rho, epsilon)
+        v.assign(v_value)
+        # パラメータは assign_add 関数でその場で更新する
+        variable.assign_add( update )
+
+    # shard_slots = True の場合, 各レプリカが担当する部分を更新する
+    def _sharded_rule(self, gradient, param, slots):
+        v, = slots
+        return rmsprop_rule(
+            gradient, v, self._get_hyper("learning_rate", param.dtype),
+            self._get_hyper("rho", param.dtype), self._get_hyper("epsilon", param.dtype)
+        )
+
+    def _fused_update_step(self, gradients, variables):
+        dtype = variables[0].dtype
+        # ハイパーパラメータはパラメータと同じデータ型にキャストしたものを取り出す
+        learning_rate = self._get_hyper("learning_rate", dtype)
+        rho = self._get_hyper("rho", dtype)
+        epsilon = self._get_hyper("epsilon", dtype)
+
+        v_list = [self._get_slots(variable)[0] for variable in variables]
+
+        # 勾配と二次モーメントをそれぞれ1つのテンソルに連結
+        gradient = self._flatten_concat(gradients)
+        v = self._flatten_concat(v_list)
+
+        # 連結したテンソルにも, 変数ごとの更新と同じ更新式を用いる
+        update, (v,) = rmsprop_rule(gradient, v, learning_rate, rho, epsilon)
+
+        # 分割して各変数に書き戻す
+        for x, value in zip(v_list, self._split_like(v, v_list)):
+            x.assign(value)
+        for variable, value in zip(variables, self._split_like(update, variables)):
+            variable.assign_add(value)
+
+    # Instrumentation で記録するモーメントの統計量
+    def _moment_statistics(self, var_list):
+        v = list()
+        for variable in var_list:
+            x, = self._get_slots(variable)
+            v.append(self._reconstruct_factored(*x) if isinstance(x, tuple) else x)
+        return {
+            "v_min": tf.reduce_min([tf.reduce_min(x) for x in v]),
+            "v_max": tf.reduce_max([tf.reduce_max(x) for x in v]),
+        }
@@ -0,0 +1,58 @@
+import tensorflow as tf
+
+# パラメータの平均を保持するクラス (CustomOptimizer の averaging に指定する)
+#   mode = "ema": 指数移動平均 average = average + (1 - decay) * (w - average)
+#   mode = "swa": start_step 以降の単純平均 average = average + (w - average) / (n + 1)
+#   mode = "lookahead": slow = slow + alpha * (w - slow) の後, w = slow とする (Lookahead の遅い重みと速い重み)
+# 平均は start_step ステップ以降, every_n_steps ステップごとにグラフ内で更新する
+# 保持する変数はパラメータごとに1つ (マスターコピーがある場合はマスターコピーと同じ float32 で保持する)
+class WeightAveraging:
+    def __init__(self, mode = "ema", decay = 0.999, alpha = 0.5, every_n_steps = 1, start_step = 0):
+        if mode not in ("ema", "swa", "lookahead"):
+            raise ValueError(f"`mode` must be one of 'ema', 'swa' or 'lookahead'. Received: mode={mode}")
+        self.mode = mode
+        self.decay = decay
+        self.alpha = alpha
+        self.every_n_steps = every_n_steps
+        self.start_step = start_step
+
+    # パラメータを更新した後, 平均を更新するステップのみ平均を更新する
+    def apply(self, optimizer, apply_gradients, distribution, grads_and_vars, **kwargs):
+        iterations = apply_gradients(distribution, grads_and_vars, **kwargs)
+        with tf.control_dependencies([iterations]):
+            # self.iterations は更新後の値 (これまでにパラメータを更新した回数)
+            step = optimizer.iterations - self.start_step
+            return tf.cond(
+                (step >= 0) & (step % self.every_n_steps == 0),
+                lambda: tf.identity(self._update(optimizer, distribution, grads_and_vars, iterations)),
+                lambda: tf.identity(iterations),
+            )
+
+    def _update(self, optimizer, distribution, grads_and_vars, iterations):
+        if self.mode == "swa":
+            count = optimizer._average_count.assign_add(1)
+            # 1回目は average = w になる
+            rate = 1 / tf.cast(count, tf.float32)
+        elif self.mode == "ema":
+            rate = tf.constant(1 - self.decay, tf.float32)
+        else:
+            rate = tf.constant(self.alpha, tf.float32)
+
+        def update_average(average, target):
+            average.assign_add(tf.cast(rate, average.dtype) * (target - average))
+
+        def sync(target, average):
+            target.assign(average)
+
+        for _, variable in grads_and_vars:
+            target, average = optimizer._get_average(variable)
+            # 分散学習中も各デバイスの変数を更新できるように extended.update を用いる
+            distribution.extended.update(average, update_average, args = (target,), group = False)
+            if self.mode != "lookahead":
+                continue
+            # Lookahead は速い重みを遅い重みに戻す
+            distribution.extended.update(target, sync, args = (average,), group = False)
+            # マスターコピーを戻した場合は, 低精度のパラメータにも反映する
+            if target is not variable:
+                distribution.extended.update(variable, sync, args = (tf.cast(target, variable.dtype),), group = False)
+        return iterations
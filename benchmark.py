@@ -0,0 +1,256 @@
+import argparse
+import functools
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from AdaBelief import AdaBelief
+from AdaGrad import AdaGrad
+from Adam import Adam
+from CustomOptimizer import CustomOptimizer
+from Indian import Indian
+from LAMB import LAMB
+from LARS import LARS
+from Momentum import Momentum
+from NAG import NAG
+from Nadian import Nadian
+from RMSprop import RMSprop
+from SGD import SGD
+
+# 計測する最適化手法
+# NAG, Nadian は, XLA でコンパイルでき, tape.gradient の前後でパラメータを書き換えない shifted = True で計測する
+OPTIMIZERS = {
+    "SGD": SGD,
+    "Momentum": Momentum,
+    "NAG": functools.partial(NAG, shifted = True),
+    "AdaGrad": AdaGrad,
+    "RMSprop": RMSprop,
+    "Adam": Adam,
+    "AdaBelief": AdaBelief,
+    "Indian": Indian,
+    "Nadian": functools.partial(Nadian, shifted = True),
+    "LAMB": LAMB,
+    "LARS": LARS,
+}
+
+# Keras の同等の最適化手法 (ハイパーパラメータは同じ値にそろえる)
+KERAS_EQUIVALENTS = {
+    "SGD": (
+        lambda: SGD(learning_rate = 0.01),
+        lambda: tf.keras.optimizers.SGD(learning_rate = 0.01),
+    ),
+    "Momentum": (
+        lambda: Momentum(learning_rate = 0.01, mu = 0.9),
+        lambda: tf.keras.optimizers.SGD(learning_rate = 0.01, momentum = 0.9),
+    ),
+    "AdaGrad": (
+        lambda: AdaGrad(learning_rate = 0.001, epsilon = 1e-7),
+        lambda: tf.keras.optimizers.Adagrad(learning_rate = 0.001, initial_accumulator_value = 0.0, epsilon = 1e-7),
+    ),
+    "RMSprop": (
+        lambda: RMSprop(learning_rate = 0.001, rho = 0.9, epsilon = 1e-7),
+        lambda: tf.keras.optimizers.RMSprop(learning_rate = 0.001, rho = 0.9, epsilon = 1e-7),
+    ),
+    "Adam": (
+        lambda: Adam(learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7),
+        lambda: tf.keras.optimizers.Adam(learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7),
+    ),
+}
+
+def build_mlp(batch_size):
+    model = tf.keras.Sequential([
+        tf.keras.layers.Dense(256, activation = "relu"),
+        tf.keras.layers.Dense(256, activation = "relu"),
+        tf.keras.layers.Dense(10),
+    ])
+    x = tf.random.normal((batch_size, 64))
+    y = tf.random.uniform((batch_size,), maxval = 10, dtype = tf.int32)
+    model(x)
+    return model, x, y
+
+def build_cnn(batch_size):
+    model = tf.keras.Sequential([
+        tf.keras.layers.Conv2D(32, 3, activation = "relu"),
+        tf.keras.layers.MaxPooling2D(),
+        tf.keras.layers.Conv2D(64, 3, activation = "relu"),
+        tf.keras.layers.GlobalAveragePooling2D(),
+        tf.keras.layers.Dense(10),
+    ])
+    x = tf.random.normal((batch_size, 32, 32, 3))
+    y = tf.random.uniform((batch_size,), maxval = 10, dtype = tf.int32)
+    model(x)
+    return model, x, y
+
+# 埋め込み層の勾配は tf.IndexedSlices になる
+def build_embedding(batch_size):
+    model = tf.keras.Sequential([
+        tf.keras.layers.Embedding(100000, 64),
+        tf.keras.layers.GlobalAveragePooling1D(),
+        tf.keras.layers.Dense(10),
+    ])
+    x = tf.random.uniform((batch_size, 20), maxval = 100000, dtype = tf.int32)
+    y = tf.random.uniform((batch_size,), maxval = 10, dtype = tf.int32)
+    model(x)
+    return model, x, y
+
+# 小さな変数を多数持つモデル
+def build_many_small(batch_size):
+    layers = list()
+    for _ in range(100):
+        layers.append(tf.keras.layers.Dense(16, activation = "relu"))
+        layers.append(tf.keras.layers.LayerNormalization())
+    layers.append(tf.keras.layers.Dense(10))
+    model = tf.keras.Sequential(layers)
+    x = tf.random.normal((batch_size, 16))
+    y = tf.random.uniform((batch_size,), maxval = 10, dtype = tf.int32)
+    model(x)
+    return model, x, y
+
+# 計測に用いるモデル
+MODELS = {
+    "mlp": build_mlp,
+    "cnn": build_cnn,
+    "embedding": build_embedding,
+    "many_small": build_many_small,
+}
+
+def make_train_step(model, optimizer, jit_compile):
+    loss_fn = tf.keras.losses.SparseCategoricalCrossentropy(from_logits = True)
+
+    @tf.function(jit_compile = jit_compile)
+    def train_step(x, y):
+        with tf.GradientTape() as tape:
+            loss = loss_fn(y, model(x, training = True))
+        optimizer.minimize(loss, model.trainable_variables, tape = tape)
+        return loss
+
+    return train_step
+
+# 1ステップあたりの時間 (秒) を計測する
+def measure(train_step, x, y, steps, warmup):
+    for _ in range(warmup):
+        train_step(x, y).numpy()
+    latencies = list()
+    for _ in range(steps):
+        start = time.perf_counter()
+        train_step(x, y).numpy()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+# 最適化手法が保持する変数のバイト数
+def slot_bytes(optimizer):
+    return sum(variable.shape.num_elements() * variable.dtype.size for variable in optimizer.variables)
+
+def run_one(build_model, optimizer_factory, steps, warmup, batch_size):
+    model, x, y = build_model(batch_size)
+    optimizer = optimizer_factory()
+    train_step = make_train_step(model, optimizer, False)
+
+    # 初回の呼び出しにはトレースの時間が含まれる
+    start = time.perf_counter()
+    train_step(x, y).numpy()
+    trace_seconds = time.perf_counter() - start
+
+    latencies = measure(train_step, x, y, steps, warmup)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "steps_per_second": float(1 / np.mean(latencies)),
+        "slot_bytes": int(slot_bytes(optimizer)),
+        "trace_seconds": float(trace_seconds),
+    }
+
+# Keras の最適化手法との比較
+def run_keras(steps, warmup, batch_size):
+    results = dict()
+    for model_name, build_model in MODELS.items():
+        results[model_name] = dict()
+        for name, (custom_factory, keras_factory) in KERAS_EQUIVALENTS.items():
+            results[model_name][name] = {
+                "custom": run_one(build_model, custom_factory, steps, warmup, batch_size),
+                "keras": run_one(build_model, keras_factory, steps, warmup, batch_size),
+            }
+    return results
+
+# XLA でコンパイルした場合としない場合の比較
+def run_xla(steps, warmup, batch_size):
+    results = dict()
+    for name, optimizer_class in OPTIMIZERS.items():
+        result = dict()
+        for jit_compile in (False, True):
+            model, x, y = build_mlp(batch_size)
+            optimizer = optimizer_class()
+            # 変数の作成はコンパイルする関数の外で行う
+            optimizer.build(model.trainable_variables)
+            train_step = make_train_step(model, optimizer, jit_compile)
+            if jit_compile:
+                # jit_compile = True の tf.function は1つのクラスタにコンパイルできない場合に例外を送出する
+                try:
+                    train_step.experimental_get_compiler_ir(x, y)(stage = "hlo")
+                    result["single_cluster"] = True
+                except Exception as error:
+                    result["single_cluster"] = False
+                    result["error"] = str(error)
+                    continue
+            latencies = measure(train_step, x, y, steps, warmup)
+            result["xla_ms" if jit_compile else "graph_ms"] = float(np.mean(latencies) * 1000)
+        if result["single_cluster"]:
+            result["speedup"] = result["graph_ms"] / result["xla_ms"]
+        results[name] = result
+    return results
+
+# fused = True (同じデータ型の変数を連結して更新する) と fused = False の比較
+# fused に対応する最適化手法について, 大きな変数を持つ mlp と小さな変数を多数持つ many_small で,
+# 最適化手法の jit_compile を変えてそれぞれ計測する
+def run_fused(steps, warmup, batch_size):
+    results = dict()
+    for model_name in ("mlp", "many_small"):
+        results[model_name] = dict()
+        for name, optimizer_class in OPTIMIZERS.items():
+            if getattr(optimizer_class, "func", optimizer_class)._fused_update_step is CustomOptimizer._fused_update_step:
+                continue
+            results[model_name][name] = dict()
+            for jit_compile in (False, True):
+                result = {
+                    "unfused_ms": run_one(
+                        MODELS[model_name], functools.partial(optimizer_class, jit_compile = jit_compile, fused = False), steps, warmup, batch_size
+                    )["p50_ms"],
+                    "fused_ms": run_one(
+                        MODELS[model_name], functools.partial(optimizer_class, jit_compile = jit_compile, fused = True),
+                        steps, warmup, batch_size
+                    )["p50_ms"],
+                }
+                result["speedup"] = result["unfused_ms"] / result["fused_ms"]
+                results[model_name][name][f"jit_compile={jit_compile}"] = result
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type = int, default = 100)
+    parser.add_argument("--warmup", type = int, default = 10)
+    parser.add_argument("--batch_size", type = int, default = 128)
+    parser.add_argument("--suite", choices = ["keras", "xla", "fused", "all"], default = "all")
+    parser.add_argument("--output", default = None)
+    args = parser.parse_args()
+
+    # CPU のみで計測する
+    tf.config.set_visible_devices([], "GPU")
+
+    results = {"tensorflow": tf.__version__}
+    if args.suite in ("keras", "all"):
+        results["keras"] = run_keras(args.steps, args.warmup, args.batch_size)
+    if args.suite in ("xla", "all"):
+        results["xla"] = run_xla(args.steps, args.warmup, args.batch_size)
+    if args.suite in ("fused", "all"):
+        results["fused"] = run_fused(args.steps, args.warmup, args.batch_size)
+    text = json.dumps(results, indent = 2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    main()
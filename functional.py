@@ -0,0 +1,276 @@
+import collections
+
+import tensorflow as tf
+
+# 各最適化手法の状態を持たない実装
+#   state = optimizer.init(params)
+#   params, state = optimizer.update(grads, state, params)
+# params, grads はテンソルの入れ子構造 (リスト, 辞書など), state は更新の回数 step と, params と同じ構造の保持する値の辞書
+# 変数を作成せず, 入力から出力を求めるだけなので, tf.function, tf.vectorized_map, tf.while_loop の中でそのまま用いることができる
+# ハイパーパラメータは数値, テンソル, または step を受け取る関数 (LearningRateSchedule など)
+# 数値はクラスの実装と同じく float32 にしてから, パラメータのデータ型にキャストする
+#
+# NAG, Nadian は shifted = True と同じく, パラメータを先読みした点で保持する
+# 本来のパラメータは true_params(state, params) で求める (他の最適化手法では params をそのまま返す)
+#
+# 更新式 (*_rule など) はクラスの実装 (SGD.py など) と共有する. クラスはハイパーパラメータを
+# ステップごとに1度だけ求めて更新式に渡し, 戻り値を変数に書き込むだけにする
+FunctionalOptimizer = collections.namedtuple("FunctionalOptimizer", ["init", "update", "true_params"])
+
+# 各最適化手法の更新式
+# 勾配と保持する値, パラメータのデータ型にしたハイパーパラメータを受け取り, (パラメータに加える更新量, 更新後の保持する値) を返す
+# パラメータのノルムを用いるもの以外は要素ごとの演算のみなので, 連結したテンソルにもそのまま用いられる
+def sgd_rule(gradient, learning_rate):
+    return -learning_rate * gradient, ()
+
+def momentum_rule(gradient, velocity, learning_rate, mu):
+    velocity = mu * velocity - learning_rate * gradient
+    return velocity, (velocity,)
+
+def adagrad_rule(gradient, h, learning_rate, epsilon):
+    h = h + gradient * gradient
+    return -learning_rate * gradient / (tf.math.sqrt(h) + epsilon), (h,)
+
+def rmsprop_rule(gradient, v, learning_rate, rho, epsilon):
+    # rho * v + (1 - rho) * g^2 = v + (1 - rho) * (g^2 - v)
+    v = v + (1 - rho) * (gradient * gradient - v)
+    return -learning_rate * gradient / (tf.math.sqrt(v) + epsilon), (v,)
+
+# Adam の一次モーメントと二次モーメントを更新する
+# (AdaBelief は勾配の代わりに, 勾配と一次モーメントの差から二次モーメントを求める)
+def adam_moments(gradient, m, v, beta_1, beta_2, belief = False):
+    m = m + (1 - beta_1) * (gradient - m)
+    residual = gradient - m if belief else gradient
+    v = v + (1 - beta_2) * (residual * residual - v)
+    return m, v
+
+# バイアス補正を学習率と epsilon に畳み込んだもの (beta_1_power, beta_2_power は beta^t)
+#   learning_rate * m_hat / (sqrt(v_hat) + epsilon) = step_size * m / (sqrt(v) + epsilon_hat)
+def corrected_step(learning_rate, epsilon, beta_1_power, beta_2_power):
+    correction_2 = tf.math.sqrt(1 - beta_2_power)
+    return learning_rate * correction_2 / (1 - beta_1_power), epsilon * correction_2
+
+# バイアス補正前のモーメントから求める m / (sqrt(v) + epsilon_hat)
+def adam_direction(m, v, epsilon_hat):
+    return m / (tf.math.sqrt(v) + epsilon_hat)
+
+def adam_rule(gradient, m, v, beta_1, beta_2, step_size, epsilon_hat, belief = False):
+    m, v = adam_moments(gradient, m, v, beta_1, beta_2, belief = belief)
+    return -step_size * adam_direction(m, v, epsilon_hat), (m, v)
+
+# Indian の y の初期値 (初回のイテレーションのみ用いる)
+def indian_init(gradient, param, alpha, beta):
+    return (1/beta - alpha) * param - beta * beta * gradient
+
+# y の変化量は, パラメータの変化量から勾配の項を除いたもの
+def indian_rule(gradient, param, y, learning_rate, alpha, beta):
+    delta_y = learning_rate * ( ((1/beta) - alpha) * param - (1/beta) * y )
+    return delta_y - learning_rate * beta * gradient, (y + delta_y,)
+
+# 信頼比. どちらかのノルムが0の場合は1にする
+def trust_ratio(numerator, denominator, weight_norm, other_norm):
+    return tf.where(
+        (weight_norm > 0) & (other_norm > 0),
+        tf.math.divide_no_nan(numerator, denominator),
+        tf.ones_like(weight_norm),
+    )
+
+# LAMB の更新量 (direction_scale = sqrt(1 - beta_2^t) / (1 - beta_1^t))
+# layer_adaptation = False の変数 (1次元以下の変数など) には信頼比と weight_decay_rate を用いない
+def lamb_update(param, m, v, learning_rate, direction_scale, epsilon_hat, weight_decay_rate, layer_adaptation):
+    update = direction_scale * adam_direction(m, v, epsilon_hat)
+    if not layer_adaptation:
+        return -learning_rate * update
+    update = update + weight_decay_rate * param
+    weight_norm, update_norm = tf.norm(param), tf.norm(update)
+    return -learning_rate * trust_ratio(weight_norm, update_norm, weight_norm, update_norm) * update
+
+# LARS の信頼比と, 信頼比を掛けた勾配 (信頼比を用いる変数のみ)
+def lars_trust_ratio(weight_norm, gradient_norm, eta, weight_decay_rate, epsilon):
+    return trust_ratio(
+        eta * weight_norm, gradient_norm + weight_decay_rate * weight_norm + epsilon, weight_norm, gradient_norm
+    )
+
+def lars_gradient(gradient, param, ratio, weight_decay_rate):
+    return ratio * (gradient + weight_decay_rate * param)
+
+# ハイパーパラメータの step での値をパラメータのデータ型で取り出す
+def _hyper(value, step, dtype):
+    if callable(value):
+        value = value(step)
+    if not tf.is_tensor(value):
+        value = tf.constant(value, tf.float32)
+    return tf.cast(value, dtype)
+
+# step での beta^(step + 1)
+def _beta_power(beta, step, dtype):
+    return tf.math.pow(_hyper(beta, step, dtype), tf.cast(step + 1, dtype))
+
+def _identity_true_params(state, params):
+    return params
+
+# 先読みした点から本来のパラメータを求める (先読みには直前の更新での mu を用いている)
+def _unshift(param, velocity, mu, step):
+    return param - _hyper(mu, step - 1, param.dtype) * velocity
+
+# slot_names の値を保持し, パラメータごとに update_leaf で更新する最適化手法を作る
+#   update_leaf(gradient, param, slots, step) は (更新後のパラメータ, 更新後の slots) を返す
+def _make_optimizer(slot_names, update_leaf, true_params = _identity_true_params):
+    def init(params):
+        state = {"step": tf.zeros((), tf.int64)}
+        for name in slot_names:
+            state[name] = tf.nest.map_structure(tf.zeros_like, params)
+        return state
+
+    def update(grads, state, params):
+        tf.nest.assert_same_structure(params, grads)
+        step = state["step"]
+        flat_params = tf.nest.flatten(params)
+        flat_grads = tf.nest.flatten(grads)
+        flat_slots = [tf.nest.flatten(state[name]) for name in slot_names]
+
+        new_params = list()
+        new_slots = [list() for _ in slot_names]
+        for i, (gradient, param) in enumerate(zip(flat_grads, flat_params)):
+            # 疎な勾配は密にする
+            gradient = tf.convert_to_tensor(gradient)
+            param, slots = update_leaf(gradient, param, [slot[i] for slot in flat_slots], step)
+            new_params.append(param)
+            for new_slot, slot in zip(new_slots, slots):
+                new_slot.append(slot)
+
+        new_state = {"step": step + 1}
+        for name, slot in zip(slot_names, new_slots):
+            new_state[name] = tf.nest.pack_sequence_as(params, slot)
+        return tf.nest.pack_sequence_as(params, new_params), new_state
+
+    return FunctionalOptimizer(init, update, true_params)
+
+# 先読みした点で保持する最適化手法の true_params
+def _shifted_true_params(mu):
+    def true_params(state, params):
+        return tf.nest.map_structure(
+            lambda param, velocity: _unshift(param, velocity, mu, state["step"]), params, state["velocity"]
+        )
+    return true_params
+
+def sgd(learning_rate = 0.01):
+    def update_leaf(gradient, param, slots, step):
+        update, slots = sgd_rule(gradient, _hyper(learning_rate, step, param.dtype))
+        return param + update, slots
+    return _make_optimizer((), update_leaf)
+
+def momentum(learning_rate = 0.01, mu = 0.9):
+    def update_leaf(gradient, param, slots, step):
+        velocity, = slots
+        update, slots = momentum_rule(
+            gradient, velocity, _hyper(learning_rate, step, param.dtype), _hyper(mu, step, param.dtype)
+        )
+        return param + update, slots
+    return _make_optimizer(("velocity",), update_leaf)
+
+# 先読みした点の勾配で本来のパラメータを Momentum と同じように更新し, 次のイテレーションの先読みした点に進める
+def nag(learning_rate = 0.01, mu = 0.9):
+    def update_leaf(gradient, param, slots, step):
+        velocity, = slots
+        mu_t = _hyper(mu, step, param.dtype)
+        true_param = _unshift(param, velocity, mu, step)
+        update, slots = momentum_rule(gradient, velocity, _hyper(learning_rate, step, param.dtype), mu_t)
+        return true_param + (1 + mu_t) * update, slots
+    return _make_optimizer(("velocity",), update_leaf, _shifted_true_params(mu))
+
+def adagrad(learning_rate = 0.001, epsilon = 1e-7):
+    def update_leaf(gradient, param, slots, step):
+        h, = slots
+        update, slots = adagrad_rule(
+            gradient, h, _hyper(learning_rate, step, param.dtype), _hyper(epsilon, step, param.dtype)
+        )
+        return param + update, slots
+    return _make_optimizer(("h",), update_leaf)
+
+def rmsprop(learning_rate = 0.001, rho = 0.9, epsilon = 1e-7):
+    def update_leaf(gradient, param, slots, step):
+        v, = slots
+        update, slots = rmsprop_rule(
+            gradient, v, _hyper(learning_rate, step, param.dtype),
+            _hyper(rho, step, param.dtype), _hyper(epsilon, step, param.dtype)
+        )
+        return param + update, slots
+    return _make_optimizer(("v",), update_leaf)
+
+# バイアス補正を畳み込んだ学習率と epsilon
+def _corrected_step(learning_rate, beta_1, beta_2, epsilon, step, dtype):
+    return corrected_step(
+        _hyper(learning_rate, step, dtype), _hyper(epsilon, step, dtype),
+        _beta_power(beta_1, step, dtype), _beta_power(beta_2, step, dtype)
+    )
+
+def _adam_family(learning_rate, beta_1, beta_2, epsilon, slot_names, belief):
+    def update_leaf(gradient, param, slots, step):
+        m, v = slots
+        step_size, epsilon_hat = _corrected_step(learning_rate, beta_1, beta_2, epsilon, step, param.dtype)
+        update, slots = adam_rule(
+            gradient, m, v, _hyper(beta_1, step, param.dtype), _hyper(beta_2, step, param.dtype),
+            step_size, epsilon_hat, belief = belief
+        )
+        return param + update, slots
+    return _make_optimizer(slot_names, update_leaf)
+
+def adam(learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7):
+    return _adam_family(learning_rate, beta_1, beta_2, epsilon, ("m", "v"), belief = False)
+
+def adabelief(learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-7):
+    return _adam_family(learning_rate, beta_1, beta_2, epsilon, ("m", "s"), belief = True)
+
+def indian(learning_rate = 0.01, alpha = 0.5, beta = 0.1):
+    def update_leaf(gradient, param, slots, step):
+        y, = slots
+        alpha_t = _hyper(alpha, step, param.dtype)
+        beta_t = _hyper(beta, step, param.dtype)
+        # 初回のみ y を初期化する (tf.where では毎回両方の値を計算してしまうので, tf.cond で一方のみ計算する)
+        y = tf.cond(step == 0, lambda: indian_init(gradient, param, alpha_t, beta_t), lambda: y)
+        update, slots = indian_rule(gradient, param, y, _hyper(learning_rate, step, param.dtype), alpha_t, beta_t)
+        return param + update, slots
+    return _make_optimizer(("y",), update_leaf)
+
+# 先読みした点から本来のパラメータを求めて Indian と同じように更新し, 次のイテレーションの先読みした点に進める
+def nadian(learning_rate = 0.01, mu = 0.9, alpha = 0.5, beta = 0.1):
+    def update_leaf(gradient, param, slots, step):
+        y, velocity = slots
+        true_param = _unshift(param, velocity, mu, step)
+        update, (y,) = indian_rule(
+            gradient, true_param, y, _hyper(learning_rate, step, param.dtype),
+            _hyper(alpha, step, param.dtype), _hyper(beta, step, param.dtype)
+        )
+        return true_param + (1 + _hyper(mu, step, param.dtype)) * update, (y, update)
+    return _make_optimizer(("y", "velocity"), update_leaf, _shifted_true_params(mu))
+
+# 1次元以下のパラメータには信頼比と weight_decay_rate を用いない
+def lamb(learning_rate = 0.001, beta_1 = 0.9, beta_2 = 0.999, epsilon = 1e-6, weight_decay_rate = 0.0):
+    def update_leaf(gradient, param, slots, step):
+        m, v = slots
+        m, v = adam_moments(gradient, m, v, _hyper(beta_1, step, param.dtype), _hyper(beta_2, step, param.dtype))
+        # 学習率を1として畳み込むと, step_size が direction_scale になる
+        direction_scale, epsilon_hat = _corrected_step(1.0, beta_1, beta_2, epsilon, step, param.dtype)
+        update = lamb_update(
+            param, m, v, _hyper(learning_rate, step, param.dtype), direction_scale, epsilon_hat,
+            _hyper(weight_decay_rate, step, param.dtype), param.shape.rank > 1
+        )
+        return param + update, (m, v)
+    return _make_optimizer(("m", "v"), update_leaf)
+
+def lars(learning_rate = 0.1, mu = 0.9, eta = 0.001, weight_decay_rate = 0.0, epsilon = 1e-9):
+    def update_leaf(gradient, param, slots, step):
+        velocity, = slots
+        if param.shape.rank > 1:
+            weight_decay_rate_t = _hyper(weight_decay_rate, step, param.dtype)
+            ratio = lars_trust_ratio(
+                tf.norm(param), tf.norm(gradient), _hyper(eta, step, param.dtype),
+                weight_decay_rate_t, _hyper(epsilon, step, param.dtype)
+            )
+            gradient = lars_gradient(gradient, param, ratio, weight_decay_rate_t)
+        update, slots = momentum_rule(
+            gradient, velocity, _hyper(learning_rate, step, param.dtype), _hyper(mu, step, param.dtype)
+        )
+        return param + update, slots
+    return _make_optimizer(("velocity",), update_leaf)
@@ -0,0 +1,671 @@
+import argparse
+import functools
+import inspect
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import functional
+from AdaBelief import AdaBelief
+from AdaGrad import AdaGrad
+from Adam import Adam
+from CustomOptimizer import CustomOptimizer
+from Indian import Indian
+from LAMB import LAMB
+from LARS import LARS
+from Momentum import Momentum
+from NAG import NAG
+from Nadian import Nadian
+from RMSprop import RMSprop
+from SGD import SGD
+
+# 各最適化手法の NumPy による参照実装
+# reference(w, grad_fn, state, t, **hyperparameters) は1ステップ後のパラメータを返す
+#   grad_fn: パラメータを受け取り勾配を返す関数 (ネステロフの加速勾配は先読みした点で呼び出す)
+#   state: 保持する変数の辞書 (初回は空), t: これまでの更新の回数
+#   look_ahead_mu (nag, nadian のみ): 先読みに用いる mu (既定では mu. shifted = True では直前の更新での mu になる)
+# ハイパーパラメータは, 最適化手法と同じく float32 に丸めてからパラメータのデータ型にする
+
+def _cast(w, *values):
+    return [w.dtype.type(np.float32(value)) for value in values]
+
+def sgd(w, grad_fn, state, t, learning_rate):
+    learning_rate, = _cast(w, learning_rate)
+    return w - learning_rate * grad_fn(w)
+
+def momentum(w, grad_fn, state, t, learning_rate, mu):
+    learning_rate, mu = _cast(w, learning_rate, mu)
+    velocity = mu * state.get("velocity", np.zeros_like(w)) - learning_rate * grad_fn(w)
+    state["velocity"] = velocity
+    return w + velocity
+
+def nag(w, grad_fn, state, t, learning_rate, mu, look_ahead_mu = None):
+    learning_rate, mu, look_ahead_mu = _cast(w, learning_rate, mu, mu if look_ahead_mu is None else look_ahead_mu)
+    velocity = state.get("velocity", np.zeros_like(w))
+    # 先読みした点での勾配
+    velocity = mu * velocity - learning_rate * grad_fn(w + look_ahead_mu * velocity)
+    state["velocity"] = velocity
+    return w + velocity
+
+def adagrad(w, grad_fn, state, t, learning_rate, epsilon):
+    learning_rate, epsilon = _cast(w, learning_rate, epsilon)
+    g = grad_fn(w)
+    h = state.get("h", np.zeros_like(w)) + g * g
+    state["h"] = h
+    return w - learning_rate * g / (np.sqrt(h) + epsilon)
+
+def rmsprop(w, grad_fn, state, t, learning_rate, rho, epsilon):
+    learning_rate, rho, epsilon = _cast(w, learning_rate, rho, epsilon)
+    g = grad_fn(w)
+    # クラスと同じ順序で計算する (rho * v + (1 - rho) * g^2 = v + (1 - rho) * (g^2 - v))
+    v = state.get("v", np.zeros_like(w))
+    v = v + (1 - rho) * (g * g - v)
+    state["v"] = v
+    return w - learning_rate * g / (np.sqrt(v) + epsilon)
+
+def adam(w, grad_fn, state, t, learning_rate, beta_1, beta_2, epsilon):
+    learning_rate, beta_1, beta_2, epsilon = _cast(w, learning_rate, beta_1, beta_2, epsilon)
+    g = grad_fn(w)
+    m = beta_1 * state.get("m", np.zeros_like(w)) + (1 - beta_1) * g
+    v = beta_2 * state.get("v", np.zeros_like(w)) + (1 - beta_2) * g * g
+    state["m"], state["v"] = m, v
+    m_hat = m / (1 - beta_1 ** (t + 1))
+    v_hat = v / (1 - beta_2 ** (t + 1))
+    return w - learning_rate * m_hat / (np.sqrt(v_hat) + epsilon)
+
+def adabelief(w, grad_fn, state, t, learning_rate, beta_1, beta_2, epsilon):
+    learning_rate, beta_1, beta_2, epsilon = _cast(w, learning_rate, beta_1, beta_2, epsilon)
+    g = grad_fn(w)
+    m = beta_1 * state.get("m", np.zeros_like(w)) + (1 - beta_1) * g
+    # 二次モーメントは更新後の一次モーメントとの差から求める
+    s = beta_2 * state.get("s", np.zeros_like(w)) + (1 - beta_2) * (g - m) * (g - m)
+    state["m"], state["s"] = m, s
+    m_hat = m / (1 - beta_1 ** (t + 1))
+    s_hat = s / (1 - beta_2 ** (t + 1))
+    return w - learning_rate * m_hat / (np.sqrt(s_hat) + epsilon)
+
+def indian(w, grad_fn, state, t, learning_rate, alpha, beta):
+    learning_rate, alpha, beta = _cast(w, learning_rate, alpha, beta)
+    g = grad_fn(w)
+    # 初回のみ y を初期化する
+    y = state["y"] if t > 0 else (1 / beta - alpha) * w - beta * beta * g
+    delta_y = learning_rate * ((1 / beta - alpha) * w - (1 / beta) * y)
+    state["y"] = y + delta_y
+    return w + delta_y - learning_rate * beta * g
+
+def nadian(w, grad_fn, state, t, learning_rate, mu, alpha, beta, look_ahead_mu = None):
+    learning_rate, alpha, beta, look_ahead_mu = _cast(w, learning_rate, alpha, beta, mu if look_ahead_mu is None else look_ahead_mu)
+    velocity = state.get("velocity", np.zeros_like(w))
+    y = state.get("y", np.zeros_like(w))
+    # 先読みした点での勾配
+    g = grad_fn(w + look_ahead_mu * velocity)
+    delta_y = learning_rate * ((1 / beta - alpha) * w - (1 / beta) * y)
+    delta = delta_y - learning_rate * beta * g
+    state["y"], state["velocity"] = y + delta_y, delta
+    return w + delta
+
+def lamb(w, grad_fn, state, t, learning_rate, beta_1, beta_2, epsilon, weight_decay_rate):
+    learning_rate, beta_1, beta_2, epsilon, weight_decay_rate = _cast(w, learning_rate, beta_1, beta_2, epsilon, weight_decay_rate)
+    g = grad_fn(w)
+    m = beta_1 * state.get("m", np.zeros_like(w)) + (1 - beta_1) * g
+    v = beta_2 * state.get("v", np.zeros_like(w)) + (1 - beta_2) * g * g
+    state["m"], state["v"] = m, v
+    update = (m / (1 - beta_1 ** (t + 1))) / (np.sqrt(v / (1 - beta_2 ** (t + 1))) + epsilon)
+    # 1次元以下の変数は Adam と同じ
+    if w.ndim <= 1:
+        return w - learning_rate * update
+    update = update + weight_decay_rate * w
+    weight_norm, update_norm = np.linalg.norm(w), np.linalg.norm(update)
+    # どちらかのノルムが0の場合は1にする
+    trust_ratio = weight_norm / update_norm if weight_norm > 0 and update_norm > 0 else 1
+    return w - learning_rate * trust_ratio * update
+
+def lars(w, grad_fn, state, t, learning_rate, mu, eta, weight_decay_rate, epsilon):
+    learning_rate, mu, eta, weight_decay_rate, epsilon = _cast(w, learning_rate, mu, eta, weight_decay_rate, epsilon)
+    g = grad_fn(w)
+    # 1次元以下の変数は Momentum と同じ
+    if w.ndim > 1:
+        weight_norm, gradient_norm = np.linalg.norm(w), np.linalg.norm(g)
+        # どちらかのノルムが0の場合は1にする
+        trust_ratio = 1
+        if weight_norm > 0 and gradient_norm > 0:
+            trust_ratio = eta * weight_norm / (gradient_norm + weight_decay_rate * weight_norm + epsilon)
+        g = trust_ratio * (g + weight_decay_rate * w)
+    velocity = mu * state.get("velocity", np.zeros_like(w)) - learning_rate * g
+    state["velocity"] = velocity
+    return w + velocity
+
+# factored = True の AdaGrad, RMSprop の参照実装
+# 2次元以上のパラメータは, 勾配の二乗の最後の2軸についての行ごとの平均と列ごとの平均のみを保持し, row ⊗ col / mean(row) として復元する
+def _factored_square(g):
+    return np.mean(g * g, axis = -1), np.mean(g * g, axis = -2)
+
+def _reconstruct_factored(row, col):
+    mean = np.mean(row, axis = -1, keepdims = True)
+    row = np.divide(row, mean, out = np.zeros_like(row), where = mean != 0)
+    return row[..., :, None] * col[..., None, :]
+
+def adagrad_factored(w, grad_fn, state, t, learning_rate, epsilon):
+    if w.ndim < 2:
+        return adagrad(w, grad_fn, state, t, learning_rate, epsilon)
+    learning_rate, epsilon = _cast(w, learning_rate, epsilon)
+    g = grad_fn(w)
+    row_square, col_square = _factored_square(g)
+    state["row"] = state.get("row", np.zeros_like(row_square)) + row_square
+    state["col"] = state.get("col", np.zeros_like(col_square)) + col_square
+    h = _reconstruct_factored(state["row"], state["col"])
+    return w - learning_rate * g / (np.sqrt(h) + epsilon)
+
+def rmsprop_factored(w, grad_fn, state, t, learning_rate, rho, epsilon):
+    if w.ndim < 2:
+        return rmsprop(w, grad_fn, state, t, learning_rate, rho, epsilon)
+    learning_rate, rho, epsilon = _cast(w, learning_rate, rho, epsilon)
+    g = grad_fn(w)
+    row_square, col_square = _factored_square(g)
+    state["row"] = rho * state.get("row", np.zeros_like(row_square)) + (1 - rho) * row_square
+    state["col"] = rho * state.get("col", np.zeros_like(col_square)) + (1 - rho) * col_square
+    v = _reconstruct_factored(state["row"], state["col"])
+    return w - learning_rate * g / (np.sqrt(v) + epsilon)
+
+FACTORED_REFERENCES = {
+    "AdaGrad": adagrad_factored,
+    "RMSprop": rmsprop_factored,
+}
+
+# 比較する最適化手法, 参照実装, ハイパーパラメータ
+# 状態を持たない実装 (functional) は同じ名前の関数を小文字にしたもの
+OPTIMIZERS = {
+    "SGD": (SGD, sgd, {"learning_rate": 0.01}),
+    "Momentum": (Momentum, momentum, {"learning_rate": 0.01, "mu": 0.9}),
+    "NAG": (NAG, nag, {"learning_rate": 0.01, "mu": 0.9}),
+    "AdaGrad": (AdaGrad, adagrad, {"learning_rate": 0.1, "epsilon": 1e-7}),
+    "RMSprop": (RMSprop, rmsprop, {"learning_rate": 0.001, "rho": 0.9, "epsilon": 1e-7}),
+    "Adam": (Adam, adam, {"learning_rate": 0.001, "beta_1": 0.9, "beta_2": 0.999, "epsilon": 1e-7}),
+    "AdaBelief": (AdaBelief, adabelief, {"learning_rate": 0.001, "beta_1": 0.9, "beta_2": 0.999, "epsilon": 1e-7}),
+    "Indian": (Indian, indian, {"learning_rate": 0.01, "alpha": 0.5, "beta": 0.1}),
+    "Nadian": (Nadian, nadian, {"learning_rate": 0.01, "mu": 0.9, "alpha": 0.5, "beta": 0.1}),
+    "LAMB": (LAMB, lamb, {"learning_rate": 0.001, "beta_1": 0.9, "beta_2": 0.999, "epsilon": 1e-6, "weight_decay_rate": 0.01}),
+    "LARS": (LARS, lars, {"learning_rate": 0.1, "mu": 0.9, "eta": 0.001, "weight_decay_rate": 0.0, "epsilon": 1e-9}),
+}
+
+# データ型ごとの許容誤差 (|w - w_ref| <= tolerance * (1 + |w_ref|))
+TOLERANCES = {
+    "float64": 1e-8,
+    "float32": 1e-3,
+}
+
+# 参照実装と同じ計算にならない設定の許容誤差 (データ型ごとの許容誤差より大きい場合はこちらを用いる)
+#   moment_dtype: モーメントを低精度で保持する, master_weights: float16 のパラメータと float32 のマスターコピー
+#   sparse, factored: 計算の順序が参照実装と異なる (最小値の近くで RMSprop の g / sqrt(v) が符号程度の大きさになると, 丸め誤差が拡大する)
+# int8 は量子化の誤差が軌道に蓄積するので, 収束後の損失も MOMENT_DTYPE_TOLERANCES で確認する
+VARIANT_TOLERANCES = {
+    ("moment_dtype", "bfloat16"): 3e-2,
+    ("moment_dtype", "int8"): 2e-1,
+    ("master_weights", True): 3e-2,
+    ("sparse", True): 1e-6,
+    ("factored", True): 1e-6,
+}
+
+# 低精度のモーメントで学習した場合の損失と, パラメータと同じデータ型のモーメントで学習した場合の損失の差の許容誤差
+# (|gap - gap_full| <= MOMENT_DTYPE_TOLERANCES[moment_dtype] * 初期値での差)
+MOMENT_DTYPE_TOLERANCES = {
+    "bfloat16": 1e-2,
+    "int8": 3e-2,
+}
+
+# 各テスト関数は, 初期値, 最小値, NumPy と TensorFlow の損失関数, NumPy の勾配を持つ
+# max_learning_rate は, 発散しないように学習率の上限とする値
+
+# 条件数の大きい二次関数 (凸)
+def build_quadratic(seed):
+    rng = np.random.default_rng(seed)
+    scale = np.logspace(-2, 0, 128).reshape(16, 8)
+    target = rng.normal(size = (16, 8))
+    return {
+        "w0": np.zeros((16, 8)),
+        "optimum": 0.0,
+        "max_learning_rate": 0.5,
+        "loss_np": lambda w: 0.5 * np.sum(scale * (w - target) ** 2),
+        "grad_np": lambda w: scale * (w - target),
+        "loss_tf": lambda w: 0.5 * tf.reduce_sum(tf.constant(scale, w.dtype) * tf.square(w - tf.constant(target, w.dtype))),
+    }
+
+# Rosenbrock 関数 (非凸)
+def build_rosenbrock(seed):
+    def loss_np(w):
+        return np.sum(100 * (w[1:] - w[:-1] ** 2) ** 2 + (1 - w[:-1]) ** 2)
+
+    def grad_np(w):
+        g = np.zeros_like(w)
+        g[:-1] = -400 * w[:-1] * (w[1:] - w[:-1] ** 2) - 2 * (1 - w[:-1])
+        g[1:] += 200 * (w[1:] - w[:-1] ** 2)
+        return g
+
+    def loss_tf(w):
+        return tf.reduce_sum(100 * tf.square(w[1:] - tf.square(w[:-1])) + tf.square(1 - w[:-1]))
+
+    return {
+        "w0": np.array([-1.2, 1.0]),
+        "optimum": 0.0,
+        "max_learning_rate": 0.001,
+        "loss_np": loss_np,
+        "grad_np": grad_np,
+        "loss_tf": loss_tf,
+    }
+
+# L2 正則化付きのロジスティック回帰 (凸)
+def build_logistic_regression(seed, l2 = 0.01):
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size = (256, 10))
+    y = (x @ rng.normal(size = (10, 1)) + 0.5 * rng.normal(size = (256, 1)) > 0).astype(np.float64)
+
+    def loss_np(w):
+        z = x @ w
+        return np.mean(np.logaddexp(0, z) - y * z) + 0.5 * l2 * np.sum(w * w)
+
+    def grad_np(w):
+        return x.T @ (1 / (1 + np.exp(-(x @ w))) - y) / len(x) + l2 * w
+
+    def loss_tf(w):
+        z = tf.constant(x, w.dtype) @ w
+        return tf.reduce_mean(tf.math.softplus(z) - tf.constant(y, w.dtype) * z) + 0.5 * l2 * tf.reduce_sum(w * w)
+
+    # 最小値はニュートン法で求める
+    w = np.zeros((10, 1))
+    for _ in range(50):
+        p = 1 / (1 + np.exp(-(x @ w)))
+        hessian = (x.T * (p * (1 - p)).T) @ x / len(x) + l2 * np.eye(10)
+        w = w - np.linalg.solve(hessian, grad_np(w))
+
+    return {
+        "w0": np.zeros((10, 1)),
+        "optimum": float(loss_np(w)),
+        "max_learning_rate": 1.0,
+        "loss_np": loss_np,
+        "grad_np": grad_np,
+        "loss_tf": loss_tf,
+    }
+
+# 用いるテスト関数
+PROBLEMS = {
+    "quadratic": build_quadratic,
+    "rosenbrock": build_rosenbrock,
+    "logistic_regression": build_logistic_regression,
+}
+
+# テスト関数に合わせたハイパーパラメータ
+def hyperparameters_for(name, problem):
+    hyperparameters = dict(OPTIMIZERS[name][2])
+    hyperparameters["learning_rate"] = min(hyperparameters["learning_rate"], problem["max_learning_rate"])
+    return hyperparameters
+
+# 参照実装と比べる設定 (更新の実装が異なる設定)
+# 最適化手法に渡さない設定
+#   functional: 状態を持たない実装で更新する
+#   sparse: 全ての行を tf.gather で取り出してから損失を求め, 疎な勾配 (tf.IndexedSlices) で更新する
+#   master_weights: パラメータを float16 にし, float32 のマスターコピーを更新する (float32 のみ)
+#   mu_change: mu を tf.Variable で渡し, 途中のステップで MU_CHANGE に変える
+def variants(optimizer_class, dtype):
+    parameters = inspect.signature(optimizer_class).parameters
+    result = [
+        {"jit_compile": False}, {"jit_compile": True}, {"functional": True},
+        {"sparse": True}, {"accumulation_steps": 2},
+    ]
+    if dtype == "float32":
+        result.append({"master_weights": True})
+    if optimizer_class._fused_update_step is not CustomOptimizer._fused_update_step:
+        result += [{"fused": False}, {"fused": True}]
+    if "shifted" in parameters:
+        result.append({"shifted": True})
+    if "mu" in parameters:
+        result.append({"mu_change": True})
+        if "shifted" in parameters:
+            result.append({"mu_change": True, "shifted": True})
+    if "lazy" in parameters:
+        result.append({"sparse": True, "lazy": True})
+    if "moment_dtype" in parameters:
+        result += [{"moment_dtype": "bfloat16"}, {"moment_dtype": "int8"}]
+    if "factored" in parameters:
+        result.append({"factored": True})
+    return result
+
+# mu_change = True で, 途中のステップから用いる mu
+MU_CHANGE = 0.5
+
+# 設定に合わせた許容誤差
+def tolerance_for(options, dtype):
+    tolerance = TOLERANCES[dtype]
+    for item in options.items():
+        tolerance = max(tolerance, VARIANT_TOLERANCES.get(item, 0.0))
+    return tolerance
+
+# 参照実装に与える勾配 (学習と同じく tf.function の中で求め, 同じ値にする)
+# NumPy や Eager で求めた勾配とは丸め誤差が異なり, 勾配が 0 に近い成分では RMSprop のように g / sqrt(v) で正規化する更新の符号が変わるため
+def make_reference_gradient(problem, dtype):
+    @tf.function
+    def gradient(w):
+        with tf.GradientTape() as tape:
+            tape.watch(w)
+            loss = problem["loss_tf"](w)
+        return tape.gradient(loss, w)
+
+    return lambda w: gradient(tf.constant(w, dtype)).numpy()
+
+def make_train_step(optimizer, variable, problem, sparse = False):
+    # 変数の作成は tf.function の外で行う
+    optimizer.build([variable])
+
+    # sparse = True の場合は全ての行を取り出すので, 勾配は密な場合と同じ値の tf.IndexedSlices になる
+    def loss_fn():
+        if sparse:
+            return problem["loss_tf"](tf.gather(variable, tf.range(variable.shape[0])))
+        return problem["loss_tf"](variable)
+
+    @tf.function
+    def train_step():
+        loss = loss_fn()
+        optimizer.minimize(loss_fn, [variable])
+        return loss
+
+    return train_step
+
+# 先読みした点で保持している場合は本来のパラメータを取り出す
+def read_class_value(optimizer, variable):
+    if hasattr(optimizer, "true_value"):
+        return optimizer.true_value(variable).numpy()
+    return variable.numpy()
+
+# 状態を持たない実装の tf.function にした1ステップ
+def make_functional_step(optimizer, problem):
+    @tf.function
+    def train_step(params, state):
+        with tf.GradientTape() as tape:
+            tape.watch(params)
+            loss = problem["loss_tf"](params)
+        return optimizer.update(tape.gradient(loss, params), state, params)
+
+    return train_step
+
+# steps ステップの間, 参照実装との誤差の最大値を求める
+def run_parity(name, problem, dtype, options, steps):
+    optimizer_class, reference, _ = OPTIMIZERS[name]
+    hyperparameters = hyperparameters_for(name, problem)
+    if options.get("factored"):
+        reference = FACTORED_REFERENCES[name]
+    # accumulation_steps 回の間はパラメータが変わらず勾配も同じなので, 参照実装の1ステップに相当する
+    substeps = options.get("accumulation_steps", 1)
+    if options.get("functional"):
+        optimizer = getattr(functional, name.lower())(**hyperparameters)
+        params = tf.constant(problem["w0"].astype(dtype))
+        optimizer_state = optimizer.init(params)
+        functional_step = make_functional_step(optimizer, problem)
+
+        def train_step():
+            nonlocal params, optimizer_state
+            params, optimizer_state = functional_step(params, optimizer_state)
+
+        def read_value():
+            return optimizer.true_params(optimizer_state, params).numpy()
+    else:
+        variable = tf.Variable(problem["w0"].astype(np.float16 if options.get("master_weights") else dtype))
+        optimizer_options = {key: value for key, value in options.items() if key not in ("sparse", "master_weights", "mu_change")}
+        optimizer_hyperparameters = dict(hyperparameters)
+        if options.get("mu_change"):
+            mu = optimizer_hyperparameters["mu"] = tf.Variable(hyperparameters["mu"], dtype = tf.float32)
+        optimizer = optimizer_class(**optimizer_hyperparameters, **optimizer_options)
+        train_step = make_train_step(optimizer, variable, problem, sparse = options.get("sparse", False))
+        read_value = lambda: read_class_value(optimizer, variable).astype(dtype)
+
+    reference = functools.partial(reference, **hyperparameters)
+    grad_fn = make_reference_gradient(problem, dtype)
+    w = problem["w0"].astype(dtype)
+    state = dict()
+    max_error = 0.0
+    # mu_change = True の場合は, 半分のステップの後に mu を変える
+    mu_values = [hyperparameters.get("mu")] * (steps // 2) + [MU_CHANGE] * (steps - steps // 2)
+    for t in range(steps):
+        reference_hyperparameters = dict()
+        if options.get("mu_change"):
+            mu.assign(mu_values[t])
+            reference_hyperparameters["mu"] = mu_values[t]
+            # shifted = True では, 先読みした点は直前の更新での mu で求めている
+            if options.get("shifted"):
+                reference_hyperparameters["look_ahead_mu"] = mu_values[max(t - 1, 0)]
+        for _ in range(substeps):
+            train_step()
+        w = reference(w, grad_fn, state, t, **reference_hyperparameters)
+        # 参照実装が発散した場合はそこまでで比較をやめる
+        if not np.all(np.isfinite(w)):
+            return {"max_error": max_error, "diverged_at": t}
+        error = np.abs(read_value() - w) / (1 + np.abs(w))
+        max_error = max(max_error, float(np.max(error)))
+    return {"max_error": max_error}
+
+# 最小値との差が初期値での差の tolerance 倍以下になるまでのステップ数と時間
+def run_convergence(name, problem, tolerance, max_steps):
+    optimizer_class, _, _ = OPTIMIZERS[name]
+    variable = tf.Variable(problem["w0"].astype(np.float32))
+    optimizer = optimizer_class(**hyperparameters_for(name, problem))
+    train_step = make_train_step(optimizer, variable, problem)
+
+    # 初回の呼び出しにはトレースの時間が含まれる
+    initial_gap = float(train_step().numpy()) - problem["optimum"]
+    steps_to_tolerance = None
+    start = time.perf_counter()
+    for step in range(1, max_steps):
+        gap = float(train_step().numpy()) - problem["optimum"]
+        if not np.isfinite(gap):
+            break
+        if gap <= tolerance * initial_gap:
+            steps_to_tolerance = step
+            break
+    seconds = time.perf_counter() - start
+
+    # ホストとの同期を含まない1ステップあたりの時間
+    start = time.perf_counter()
+    for _ in range(100):
+        loss = train_step()
+    loss.numpy()
+    return {
+        "steps_to_tolerance": steps_to_tolerance,
+        "seconds": float(seconds),
+        "steps_per_second": float(100 / (time.perf_counter() - start)),
+        "final_gap": float(problem["loss_np"](read_class_value(optimizer, variable).astype(np.float64)) - problem["optimum"]),
+    }
+
+# moment_dtype を指定できる最適化手法について, steps ステップ後の最小値との差を
+# パラメータと同じデータ型のモーメントの場合と比べる
+def run_moment_dtype(name, problem, steps, seed):
+    gaps = dict()
+    for moment_dtype in [None] + list(MOMENT_DTYPE_TOLERANCES.keys()):
+        # bfloat16 の確率的丸めと int8 の量子化は乱数を用いる
+        tf.random.set_seed(seed)
+        variable = tf.Variable(problem["w0"].astype(np.float32))
+        optimizer = OPTIMIZERS[name][0](**hyperparameters_for(name, problem), moment_dtype = moment_dtype)
+        train_step = make_train_step(optimizer, variable, problem)
+        initial_gap = float(train_step().numpy()) - problem["optimum"]
+        for _ in range(steps - 1):
+            train_step()
+        gaps[str(moment_dtype)] = float(problem["loss_np"](variable.numpy().astype(np.float64)) - problem["optimum"])
+
+    result = {"initial_gap": initial_gap, "final_gap": gaps, "passed": True}
+    for moment_dtype, tolerance in MOMENT_DTYPE_TOLERANCES.items():
+        if not abs(gaps[moment_dtype] - gaps["None"]) <= tolerance * initial_gap:
+            result["passed"] = False
+    return result
+
+FIT_MAX_LEARNING_RATE = 0.01
+
+# model.fit で学習する線形回帰のモデルとデータ
+# (重みは他のテスト関数と同じく0から始め, 学習率は FIT_MAX_LEARNING_RATE 以下にする)
+def make_fit_model(name, options, seed):
+    optimizer_class = OPTIMIZERS[name][0]
+    hyperparameters = hyperparameters_for(name, {"max_learning_rate": FIT_MAX_LEARNING_RATE})
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size = (256, 10)).astype(np.float32)
+    y = (x @ rng.normal(size = (10, 1)) + 0.1 * rng.normal(size = (256, 1))).astype(np.float32)
+    tf.keras.utils.set_random_seed(seed)
+    model = tf.keras.Sequential([tf.keras.layers.Dense(1, kernel_initializer = "zeros", input_shape = (10,))])
+    model.compile(optimizer = optimizer_class(**hyperparameters, **options), loss = "mse")
+    return model, x, y
+
+# model.compile と model.fit で学習できることを確認する
+# model.fit は計算済みの Tensor の損失と tape を compute_gradients に渡すので, 関数の損失のみを用いる比較とは別に確認する
+def run_fit(name, options, seed, epochs = 3):
+    model, x, y = make_fit_model(name, options, seed)
+    losses = model.fit(x, y, batch_size = 32, epochs = epochs, verbose = 0).history["loss"]
+    return {
+        "losses": [float(loss) for loss in losses],
+        "passed": bool(np.all(np.isfinite(losses)) and losses[-1] < losses[0]),
+    }
+
+# model.save で保存したモデルを, custom_objects を指定せずに tf.keras.models.load_model で読み込めることを確認する
+# (.keras, .h5 のそれぞれで, 最適化手法のクラス, get_config, 保持する変数が一致すること)
+def run_save_load(name, seed, directory):
+    model, x, y = make_fit_model(name, dict(), seed)
+    model.fit(x, y, batch_size = 32, epochs = 1, verbose = 0)
+    formats = dict()
+    for extension in (".keras", ".h5"):
+        path = os.path.join(directory, f"{name}{extension}")
+        model.save(path)
+        loaded = tf.keras.models.load_model(path).optimizer
+        formats[extension] = bool(
+            type(loaded) is type(model.optimizer)
+            and loaded.get_config() == model.optimizer.get_config()
+            and len(loaded.variables()) == len(model.optimizer.variables())
+            and all(
+                np.array_equal(a.numpy(), b.numpy()) for a, b in zip(loaded.variables(), model.optimizer.variables())
+            )
+        )
+    return {"formats": formats, "passed": all(formats.values())}
+
+# 集団で学習する Nadian (shifted = False, True) の exploit_and_explore を確認する
+#   置き換えたメンバーの本来のパラメータがコピー元と一致すること (先読みした点で保持する場合も)
+#   perturb を掛けた mu が1未満に収まること (コピー元の mu = 0.95 に 1.2 を掛ける)
+def run_exploit_and_explore(options, seed, steps = 10):
+    rng = np.random.default_rng(seed)
+    scale = tf.constant(rng.uniform(1.0, 5.0, size = (4, 5)).astype(np.float32))
+    variable = tf.Variable(rng.normal(size = (4, 5)).astype(np.float32))
+    optimizer = Nadian(learning_rate = 0.01, mu = [0.8, 0.85, 0.9, 0.95], population_size = 4, **options)
+    loss_fn = lambda: 0.5 * tf.reduce_sum(scale * variable * variable)
+    for _ in range(steps):
+        optimizer.minimize(loss_fn, [variable])
+    before = read_class_value(optimizer, variable)
+    # メンバー 0 を最も良いメンバー 3 で置き換える
+    source = optimizer.exploit_and_explore([0.0, 1.0, 2.0, 3.0], [variable], fraction = 0.25, perturb = (1.2,)).numpy()
+    mu = optimizer._mu.numpy()
+    error = float(np.max(np.abs(read_class_value(optimizer, variable) - before[source])))
+    for _ in range(steps):
+        optimizer.minimize(loss_fn, [variable])
+    return {
+        "source": source.tolist(), "mu": mu.tolist(), "max_error": error,
+        "passed": bool(
+            source[0] == 3 and error <= TOLERANCES["float32"] and np.all(mu < 1)
+            and np.all(np.isfinite(read_class_value(optimizer, variable)))
+        ),
+    }
+
+# baseline と比べて steps_per_second が max_slowdown 倍より遅くなったものを返す
+def find_slowdowns(results, baseline, max_slowdown):
+    slowdowns = list()
+    for problem_name, problem_results in results["convergence"].items():
+        for name, result in problem_results.items():
+            previous = baseline.get("convergence", dict()).get(problem_name, dict()).get(name)
+            if previous is None:
+                continue
+            ratio = previous["steps_per_second"] / result["steps_per_second"]
+            if ratio > max_slowdown:
+                slowdowns.append({"problem": problem_name, "optimizer": name, "slowdown": ratio})
+    return slowdowns
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--parity_steps", type = int, default = 100)
+    parser.add_argument("--max_steps", type = int, default = 10000)
+    parser.add_argument("--tolerance", type = float, default = 1e-4)
+    parser.add_argument("--dtypes", nargs = "+", default = ["float32", "float64"], choices = list(TOLERANCES.keys()))
+    parser.add_argument("--optimizers", nargs = "+", default = list(OPTIMIZERS.keys()), choices = list(OPTIMIZERS.keys()))
+    parser.add_argument("--moment_steps", type = int, default = 2000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--baseline", default = None)
+    parser.add_argument("--max_slowdown", type = float, default = 1.1)
+    parser.add_argument("--output", default = None)
+    args = parser.parse_args()
+
+    # CPU のみで計測する
+    tf.config.set_visible_devices([], "GPU")
+    problems = {name: build(args.seed) for name, build in PROBLEMS.items()}
+
+    results = {"tensorflow": tf.__version__, "parity": list(), "convergence": dict(), "moment_dtype": dict(), "fit": list(), "save_load": dict(), "exploit_and_explore": list()}
+    failures = list()
+    for problem_name, problem in problems.items():
+        for name in args.optimizers:
+            for dtype in args.dtypes:
+                for options in variants(OPTIMIZERS[name][0], dtype):
+                    result = run_parity(name, problem, dtype, options, args.parity_steps)
+                    result.update({"problem": problem_name, "optimizer": name, "dtype": dtype, "options": options})
+                    result["passed"] = result["max_error"] <= tolerance_for(options, dtype)
+                    results["parity"].append(result)
+                    if not result["passed"]:
+                        failures.append(result)
+        results["convergence"][problem_name] = {
+            name: run_convergence(name, problem, args.tolerance, args.max_steps) for name in args.optimizers
+        }
+        results["moment_dtype"][problem_name] = dict()
+        for name in args.optimizers:
+            if "moment_dtype" not in inspect.signature(OPTIMIZERS[name][0]).parameters:
+                continue
+            result = run_moment_dtype(name, problem, args.moment_steps, args.seed)
+            results["moment_dtype"][problem_name][name] = result
+            if not result["passed"]:
+                failures.append(dict(result, problem = problem_name, optimizer = name))
+
+    for name in args.optimizers:
+        # NAG, Nadian は shifted = False (既定) と shifted = True の両方
+        fit_variants = [dict()]
+        if "shifted" in inspect.signature(OPTIMIZERS[name][0]).parameters:
+            fit_variants.append({"shifted": True})
+        for options in fit_variants:
+            result = run_fit(name, options, args.seed)
+            result.update({"optimizer": name, "options": options})
+            results["fit"].append(result)
+            if not result["passed"]:
+                failures.append(result)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.optimizers:
+            result = run_save_load(name, args.seed, directory)
+            results["save_load"][name] = result
+            if not result["passed"]:
+                failures.append(dict(result, optimizer = name))
+
+    if "Nadian" in args.optimizers:
+        for options in (dict(), {"shifted": True}):
+            result = run_exploit_and_explore(options, args.seed)
+            result["options"] = options
+            results["exploit_and_explore"].append(result)
+            if not result["passed"]:
+                failures.append(result)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            results["slowdowns"] = find_slowdowns(results, json.load(f), args.max_slowdown)
+        failures += results["slowdowns"]
+
+    text = json.dumps(results, indent = 2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text)
+    # 参照実装と一致しない, または baseline より遅くなった場合は失敗とする
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()